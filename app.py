@@ -7,30 +7,177 @@ A web-based dashboard for monitoring Peplink devices via the InControl2 API.
 import http.server
 import socketserver
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
 import json
 import os
+import gc
 import hashlib
+import heapq
+import hmac
+import mmap
 import secrets
 import base64
+import bisect
+import queue
+import random
+import re
+import selectors
+import signal
+import socket
+import struct
+import sys
+import sqlite3
+import threading
+import time
+import zlib
 from urllib.parse import urlparse, parse_qs
 from http.cookies import SimpleCookie
+from email.utils import formatdate, parsedate_to_datetime
 from pathlib import Path
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from cryptography.fernet import Fernet
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
 CONFIG = {
     'client_id': os.environ.get('PEPLINK_CLIENT_ID', '1c7314d2ecc9c04138e5c7f0d1b538c9'),
     'client_secret': os.environ.get('PEPLINK_CLIENT_SECRET', '75fb1e2a82fa9ef06380a760d8b96b0e'),
     'api_url': os.environ.get('PEPLINK_API_URL', 'https://api.ic.peplink.com'),
     'port': int(os.environ.get('PORT', 8000)),
     'sso_enabled': os.environ.get('SSO_ENABLED', 'false').lower() == 'true',
+    'workers': int(os.environ.get('WORKERS', 16)),
+    'queue_size': int(os.environ.get('REQUEST_QUEUE_SIZE', 128)),
+    'request_timeout': float(os.environ.get('REQUEST_TIMEOUT', 30)),
+    'api_pool_size': int(os.environ.get('API_POOL_SIZE', 20)),
+    'api_timeout': float(os.environ.get('API_TIMEOUT', 30)),
+    'api_slow_ms': float(os.environ.get('API_SLOW_MS', 2000)),
+    'api_rate_limit': float(os.environ.get('API_RATE_LIMIT', 10)),
+    'api_burst': float(os.environ.get('API_BURST', 20)),
+    'api_429_retries': int(os.environ.get('API_429_RETRIES', 2)),
+    'metrics_token': os.environ.get('METRICS_TOKEN', ''),
+    'slow_request_ms': float(os.environ.get('SLOW_REQUEST_MS', 1000)),
+    'cache_ttl_orgs': float(os.environ.get('CACHE_TTL_ORGS', 300)),
+    'cache_ttl_groups': float(os.environ.get('CACHE_TTL_GROUPS', 30)),
+    'cache_ttl_devices': float(os.environ.get('CACHE_TTL_DEVICES', 30)),
+    'cache_stale_ttl': float(os.environ.get('CACHE_STALE_TTL', 300)),
+    'cache_max_entries': int(os.environ.get('CACHE_MAX_ENTRIES', 1000)),
+    'fanout_workers': int(os.environ.get('FANOUT_WORKERS', 8)),
+    'poll_enabled': os.environ.get('POLL_ENABLED', 'true').lower() == 'true',
+    'poll_interval': float(os.environ.get('POLL_INTERVAL', 60)),
+    'poll_jitter': float(os.environ.get('POLL_JITTER', 0.1)),
+    'inventory_max_changes': int(os.environ.get('INVENTORY_MAX_CHANGES', 50000)),
+    'compress_min_bytes': int(os.environ.get('COMPRESS_MIN_BYTES', 1024)),
+    'compress_cache_mb': float(os.environ.get('COMPRESS_CACHE_MB', 32)),
+    'static_check_interval': float(os.environ.get('STATIC_CHECK_INTERVAL', 5)),
+    'sse_heartbeat': float(os.environ.get('SSE_HEARTBEAT', 15)),
+    'sse_backlog': int(os.environ.get('SSE_BACKLOG', 1000)),
+    'sse_max_buffer_kb': int(os.environ.get('SSE_MAX_BUFFER_KB', 256)),
+    'history_enabled': os.environ.get('HISTORY_ENABLED', 'true').lower() == 'true',
+    'history_raw_hours': float(os.environ.get('HISTORY_RAW_HOURS', 24)),
+    'history_5m_days': float(os.environ.get('HISTORY_5M_DAYS', 7)),
+    'history_1h_days': float(os.environ.get('HISTORY_1H_DAYS', 90)),
+    'history_1d_days': float(os.environ.get('HISTORY_1D_DAYS', 400)),
+    'batch_workers': int(os.environ.get('BATCH_WORKERS', 16)),
+    'batch_max_operations': int(os.environ.get('BATCH_MAX_OPERATIONS', 5000)),
+    'batch_retries': int(os.environ.get('BATCH_RETRIES', 3)),
+    'batch_retry_delay': float(os.environ.get('BATCH_RETRY_DELAY', 0.5)),
+    'data_dir': os.environ.get('DATA_DIR', ''),
+    'storage_backend': os.environ.get('STORAGE_BACKEND', 'json').lower(),
+    'session_max_age': float(os.environ.get('SESSION_MAX_AGE_HOURS', 168)) * 3600,
+    'snapshot_enabled': os.environ.get('SNAPSHOT_ENABLED', 'true').lower() == 'true',
+    'snapshot_interval': float(os.environ.get('SNAPSHOT_INTERVAL', 300)),
 }
 
 DEFAULT_USERS = {'alex': 'hyrox'}
 
+# Request tracing: the handler thread owns a RequestTrace and code it calls adds spans to it
+current_trace = threading.local()
+REQUEST_ID_PATTERN = re.compile(r'^[A-Za-z0-9._:-]{1,64}$')
+# Enough for a fan-out over many orgs; a huge batch just stops recording spans
+MAX_SPANS = 500
+
+class RequestTrace:
+    __slots__ = ('request_id', 'started', 'spans', 'dropped', 'data_as_of')
+
+    def __init__(self, request_id=None):
+        self.request_id = request_id or secrets.token_hex(8)
+        self.started = time.perf_counter()
+        self.spans = []
+        self.dropped = 0
+        # Fetch time of the oldest stale data the response was built from, if any
+        self.data_as_of = None
+
+    def add(self, name, started, duration):
+        if len(self.spans) >= MAX_SPANS:
+            self.dropped += 1
+            return
+        self.spans.append((name, started - self.started, duration, threading.current_thread().name))
+
+    def breakdown(self):
+        lines = [f'  {offset * 1000:9.1f}ms +{duration * 1000:8.1f}ms  {name}  [{thread}]'
+                 for name, offset, duration, thread in sorted(self.spans, key=lambda item: item[1])]
+        if self.dropped:
+            lines.append(f'  ... {self.dropped} more spans not recorded')
+        return '\n'.join(lines)
+
+class span:
+    """Time a block as a span of the current request; a no-op outside a traced request"""
+    __slots__ = ('name', 'trace', 'started')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.trace = getattr(current_trace, 'trace', None)
+        if self.trace is not None:
+            self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self.trace is not None:
+            self.trace.add(self.name, self.started, time.perf_counter() - self.started)
+
+def mark_stale(as_of):
+    """Note that the current request is serving IC2 data last fetched at as_of (epoch seconds)"""
+    trace = getattr(current_trace, 'trace', None)
+    if trace is not None and (trace.data_as_of is None or as_of < trace.data_as_of):
+        trace.data_as_of = as_of
+
+def traced(fn):
+    """Wrap fn so that, run on a pool thread, its spans land in the submitting request's trace"""
+    trace = getattr(current_trace, 'trace', None)
+    if trace is None:
+        return fn
+
+    def run(*args, **kwargs):
+        previous = getattr(current_trace, 'trace', None)
+        current_trace.trace = trace
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            current_trace.trace = previous
+    return run
+
 # Encryption key management
-ENCRYPTION_KEY_FILE = Path(__file__).parent / '.encryption_key'
-USERS_DB_FILE = Path(__file__).parent / '.users_db.json'
-LOCKED_GROUPS_FILE = Path(__file__).parent / '.locked_groups.json'
+DATA_DIR = Path(CONFIG['data_dir']) if CONFIG['data_dir'] else Path(__file__).parent
+ENCRYPTION_KEY_FILE = DATA_DIR / '.encryption_key'
+USERS_DB_FILE = DATA_DIR / '.users_db.json'
+LOCKED_GROUPS_FILE = DATA_DIR / '.locked_groups.json'
+SESSIONS_FILE = DATA_DIR / '.sessions.json'
+STORE_DB_FILE = DATA_DIR / '.store.db'
+HISTORY_DB_FILE = DATA_DIR / '.history.db'
+SNAPSHOT_FILE = DATA_DIR / '.inventory.snapshot'
 
 def get_or_create_encryption_key():
     """Get existing encryption key or create a new one"""
@@ -55,182 +202,2224 @@ def decrypt_password(encrypted_password):
     except:
         return None
 
-def load_users_from_db():
-    """Load users from encrypted database file"""
-    if USERS_DB_FILE.exists():
+class JsonStore:
+    """Key/value records kept in memory and persisted to one JSON file.
+
+    Reads are served from memory; the file is only re-parsed when its mtime or
+    size changes (someone edited it by hand or restored a backup). Writes update
+    memory immediately and are flushed together after flush_delay seconds, by
+    writing a temp file and renaming it over the old one so a crash never leaves
+    a half-written file behind.
+    """
+
+    def __init__(self, path, mode=None, flush_delay=0.5):
+        self.path = Path(path)
+        self.mode = mode
+        self.flush_delay = flush_delay
+        self._lock = threading.RLock()
+        self._data = {}
+        self._stamp = None
+        self._dirty = False
+        self._timer = None
+        self._reload()
+
+    def _stat(self):
         try:
-            data = json.loads(USERS_DB_FILE.read_text())
-            return data
-        except:
-            pass
-    # Initialize with default users
-    default_db = {}
+            st = self.path.stat()
+            return st.st_mtime_ns, st.st_size
+        except FileNotFoundError:
+            return None
+
+    def _reload(self):
+        stamp = self._stat()
+        if stamp == self._stamp:
+            return
+        data = {}
+        if stamp is not None:
+            try:
+                with span(f'store read {self.path.name}'):
+                    data = json.loads(self.path.read_text())
+            except (OSError, ValueError) as e:
+                print(f'[STORE] Could not read {self.path.name}: {e}')
+                if self._stamp is not None:
+                    return
+        self._data = data if isinstance(data, dict) else {}
+        self._stamp = stamp
+
+    def _current(self):
+        # Unflushed writes win over whatever is on disk
+        if not self._dirty:
+            self._reload()
+        return self._data
+
+    def get(self, key, default=None):
+        with self._lock:
+            return self._current().get(key, default)
+
+    def snapshot(self):
+        """Copy of all records; values must be treated as read-only"""
+        with self._lock:
+            return dict(self._current())
+
+    def put(self, key, value):
+        with self._lock:
+            self._current()[key] = value
+            self._changed()
+
+    def add(self, key, value):
+        """Insert key unless it already exists; returns whether it was added"""
+        with self._lock:
+            data = self._current()
+            if key in data:
+                return False
+            data[key] = value
+            self._changed()
+            return True
+
+    def modify(self, key, fn):
+        """Replace an existing value with fn(copy of value); returns the new value or None"""
+        with self._lock:
+            data = self._current()
+            if key not in data:
+                return None
+            data[key] = fn(dict(data[key]))
+            self._changed()
+            return data[key]
+
+    def delete(self, key):
+        with self._lock:
+            data = self._current()
+            if key not in data:
+                return False
+            del data[key]
+            self._changed()
+            return True
+
+    def delete_where(self, predicate):
+        """Delete every record for which predicate(key, value) is true; returns the count"""
+        with self._lock:
+            data = self._current()
+            doomed = [key for key, value in data.items() if predicate(key, value)]
+            for key in doomed:
+                del data[key]
+            if doomed:
+                self._changed()
+            return len(doomed)
+
+    def _changed(self):
+        self._dirty = True
+        if self._timer is None:
+            self._timer = threading.Timer(self.flush_delay, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def flush(self):
+        with self._lock:
+            self._timer = None
+            if not self._dirty:
+                return
+            tmp = self.path.with_name(self.path.name + '.tmp')
+            try:
+                with open(tmp, 'w') as f:
+                    if self.mode is not None:
+                        os.chmod(tmp, self.mode)
+                    json.dump(self._data, f, indent=2)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp, self.path)
+            except OSError as e:
+                print(f'[STORE] Could not write {self.path.name}: {e}')
+                return
+            self._dirty = False
+            self._stamp = self._stat()
+
+class SqliteStore:
+    """The JsonStore interface backed by one table of a shared SQLite database"""
+
+    def __init__(self, path, table):
+        self.path = path
+        self.table = table
+        self._local = threading.local()
+        with self.connect() as db:
+            db.execute(f'CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+
+    def connect(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self._local.db = db
+        return db
+
+    def get(self, key, default=None):
+        row = self.connect().execute(f'SELECT value FROM {self.table} WHERE key = ?', (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def snapshot(self):
+        return {key: json.loads(value) for key, value in self.connect().execute(f'SELECT key, value FROM {self.table}')}
+
+    def put(self, key, value):
+        with self.connect() as db:
+            db.execute(f'INSERT OR REPLACE INTO {self.table} (key, value) VALUES (?, ?)', (key, json.dumps(value)))
+
+    def add(self, key, value):
+        with self.connect() as db:
+            cursor = db.execute(f'INSERT OR IGNORE INTO {self.table} (key, value) VALUES (?, ?)',
+                                (key, json.dumps(value)))
+            return cursor.rowcount == 1
+
+    def modify(self, key, fn):
+        db = self.connect()
+        with db:
+            db.execute('BEGIN IMMEDIATE')
+            row = db.execute(f'SELECT value FROM {self.table} WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            value = fn(json.loads(row[0]))
+            db.execute(f'UPDATE {self.table} SET value = ? WHERE key = ?', (json.dumps(value), key))
+            return value
+
+    def delete(self, key):
+        with self.connect() as db:
+            return db.execute(f'DELETE FROM {self.table} WHERE key = ?', (key,)).rowcount == 1
+
+    def delete_where(self, predicate):
+        db = self.connect()
+        with db:
+            db.execute('BEGIN IMMEDIATE')
+            doomed = [(key,) for key, value in db.execute(f'SELECT key, value FROM {self.table}')
+                      if predicate(key, json.loads(value))]
+            db.executemany(f'DELETE FROM {self.table} WHERE key = ?', doomed)
+            return len(doomed)
+
+    def flush(self):
+        pass
+
+def open_store(json_path, table, mode=None):
+    if CONFIG['storage_backend'] == 'sqlite':
+        return SqliteStore(STORE_DB_FILE, table)
+    return JsonStore(json_path, mode=mode)
+
+users = open_store(USERS_DB_FILE, 'users', mode=0o600)
+locked_groups = open_store(LOCKED_GROUPS_FILE, 'locked_groups')
+sessions = open_store(SESSIONS_FILE, 'sessions', mode=0o600)
+
+if not users.snapshot():
     for username, password in DEFAULT_USERS.items():
-        default_db[username] = {
-            'password': encrypt_password(password),
-            'role': 'admin'
-        }
-    save_users_to_db(default_db)
-    return default_db
+        users.add(username, {'password': encrypt_password(password), 'role': 'admin'})
 
-def save_users_to_db(users_db):
-    """Save users to encrypted database file"""
-    USERS_DB_FILE.write_text(json.dumps(users_db, indent=2))
-    USERS_DB_FILE.chmod(0o600)
+# username -> (encrypted password, keyed digest of the plaintext) so repeated logins skip Fernet
+_password_verifiers = {}
+_verifier_key = secrets.token_bytes(32)
+
+def password_digest(password):
+    return hmac.new(_verifier_key, password.encode(), hashlib.sha256).digest()
 
 def verify_user_password(username, password):
     """Verify username and password"""
-    users_db = load_users_from_db()
-    if username not in users_db:
+    user = users.get(username)
+    if user is None:
         return False
-    encrypted_pwd = users_db[username]['password']
-    decrypted_pwd = decrypt_password(encrypted_pwd)
-    return decrypted_pwd == password if decrypted_pwd else False
+    encrypted_pwd = user['password']
+    cached = _password_verifiers.get(username)
+    if cached is None or cached[0] != encrypted_pwd:
+        decrypted_pwd = decrypt_password(encrypted_pwd)
+        if decrypted_pwd is None:
+            return False
+        cached = (encrypted_pwd, password_digest(decrypted_pwd))
+        _password_verifiers[username] = cached
+    return hmac.compare_digest(cached[1], password_digest(password))
 
-def load_locked_groups():
-    """Load locked groups from file"""
-    if LOCKED_GROUPS_FILE.exists():
-        try:
-            return json.loads(LOCKED_GROUPS_FILE.read_text())
-        except:
-            pass
-    return {}
+# Upper bounds (seconds) of the latency histogram buckets, shared by every histogram
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
 
-def save_locked_groups(locked_groups):
-    """Save locked groups to file"""
-    LOCKED_GROUPS_FILE.write_text(json.dumps(locked_groups, indent=2))
+class Counter:
+    """Prometheus counter keyed by label values"""
+    kind = 'counter'
 
-locked_groups = load_locked_groups()
-USERS = load_users_from_db()
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.values = {}
+        self._lock = threading.Lock()
+        METRICS.append(self)
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        with self._lock:
+            values = list(self.values.items())
+        for label_values, value in values:
+            yield f'{self.name}{format_labels(self.labels, label_values)} {value}'
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def set(self, *label_values, value):
+        with self._lock:
+            self.values[label_values] = value
+
+class Histogram:
+    """Prometheus histogram; each label set gets its bucket counts allocated once"""
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}
+        self._lock = threading.Lock()
+        METRICS.append(self)
+
+    def observe(self, value, *label_values):
+        slot = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self.series.get(label_values)
+            if series is None:
+                # Bucket counts, then the +Inf bucket, then the sum
+                series = self.series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[slot] += 1
+            series[-1] += value
+
+    def render(self):
+        with self._lock:
+            series = [(label_values, list(counts)) for label_values, counts in self.series.items()]
+        names = self.labels + ('le',)
+        for label_values, counts in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                yield f'{self.name}_bucket{format_labels(names, label_values + (bound,))} {cumulative}'
+            yield f'{self.name}_sum{format_labels(self.labels, label_values)} {counts[-1]:.6f}'
+            yield f'{self.name}_count{format_labels(self.labels, label_values)} {cumulative}'
+
+METRICS = []
+http_requests = Counter('ic2_manager_http_requests_total', 'HTTP requests handled, by route template', ('method', 'route', 'status'))
+http_latency = Histogram('ic2_manager_http_request_duration_seconds', 'Time to handle an HTTP request', ('method', 'route'))
+http_in_flight = Gauge('ic2_manager_http_requests_in_flight', 'HTTP requests currently being handled')
+upstream_requests = Counter('ic2_manager_upstream_requests_total', 'IC2 API responses, by endpoint template', ('method', 'endpoint', 'status'))
+upstream_errors = Counter('ic2_manager_upstream_errors_total', 'IC2 API calls that failed without a response', ('method', 'endpoint'))
+upstream_latency = Histogram('ic2_manager_upstream_request_duration_seconds', 'IC2 API call time including the body transfer', ('method', 'endpoint'))
+upstream_bytes = Counter('ic2_manager_upstream_response_bytes_total', 'IC2 API response body bytes', ('method', 'endpoint'))
+token_refreshes = Counter('ic2_manager_upstream_token_requests_total', 'OAuth token requests', ('result',))
+
+def upstream_template(endpoint):
+    """/rest/o/123/g/4/d -> /rest/o/{org}/g/{group}/d, keeping label cardinality bounded"""
+    parts = endpoint.split('/')
+    if len(parts) < 3 or parts[1] != 'rest':
+        return endpoint
+    for i in range(3, len(parts), 2):
+        parts[i] = {'o': '{org}', 'g': '{group}', 'd': '{device}'}.get(parts[i - 1], '{id}')
+    return '/'.join(parts)
+
+# Seconds before expiry at which the OAuth token is proactively refreshed
+TOKEN_REFRESH_MARGIN = 60
+# Seconds to wait after a failed token request before trying OAuth again
+AUTH_RETRY_DELAY = 5
+
+# Connection setup time of the current thread's upstream request
+upstream_timing = threading.local()
+
+class TimedHTTPConnection(HTTPConnection):
+    def connect(self):
+        started = time.perf_counter()
+        super().connect()
+        upstream_timing.connect_ms = (time.perf_counter() - started) * 1000
+
+class TimedHTTPSConnection(HTTPSConnection):
+    def connect(self):
+        started = time.perf_counter()
+        super().connect()
+        upstream_timing.connect_ms = (time.perf_counter() - started) * 1000
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+class TimedHTTPAdapter(HTTPAdapter):
+    """Keep-alive connection pool that records TCP/TLS connect time"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': TimedHTTPConnectionPool,
+            'https': TimedHTTPSConnectionPool,
+        }
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+PRIORITY_BACKGROUND = 2
+PRIORITY_NAMES = ('interactive', 'bulk', 'background')
+
+# Lane for the calling thread; request handlers stay interactive unless told otherwise
+upstream_priority = threading.local()
+
+class use_priority:
+    """Run a block of upstream calls in the given scheduler lane"""
+
+    def __init__(self, priority):
+        self.priority = priority
+
+    def __enter__(self):
+        self.previous = getattr(upstream_priority, 'lane', PRIORITY_INTERACTIVE)
+        upstream_priority.lane = self.priority
+
+    def __exit__(self, *exc):
+        upstream_priority.lane = self.previous
+
+def retry_after_seconds(value, default):
+    """Seconds from a Retry-After header (delta-seconds or HTTP date)"""
+    if not value:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return default
+
+class UpstreamScheduler:
+    """Token bucket shared by every IC2 call, handing out tokens by priority lane.
+
+    Callers queue in their thread's lane and are released strictly by priority
+    (interactive, then bulk, then background), FIFO within a lane. A 429 from
+    IC2 pauses all lanes until its Retry-After has passed.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.throttled = 0
+        self._queue = []
+        self._seq = 0
+        self._cond = threading.Condition()
+        self.lanes = [{'queued': 0, 'sent': 0, 'wait_total_ms': 0.0, 'wait_max_ms': 0.0}
+                      for _ in PRIORITY_NAMES]
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        """Block until the calling thread may send one upstream request"""
+        if self.rate <= 0:
+            return
+        lane = getattr(upstream_priority, 'lane', PRIORITY_INTERACTIVE)
+        started = time.monotonic()
+        with self._cond:
+            self._seq += 1
+            ticket = (lane, self._seq)
+            heapq.heappush(self._queue, ticket)
+            self.lanes[lane]['queued'] += 1
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                if self._queue[0] == ticket:
+                    if now < self.paused_until:
+                        self._cond.wait(self.paused_until - now)
+                    elif self.tokens < 1:
+                        self._cond.wait((1 - self.tokens) / self.rate)
+                    else:
+                        break
+                else:
+                    self._cond.wait()
+            heapq.heappop(self._queue)
+            self.tokens -= 1
+            waited_ms = (time.monotonic() - started) * 1000
+            stats = self.lanes[lane]
+            stats['queued'] -= 1
+            stats['sent'] += 1
+            stats['wait_total_ms'] += waited_ms
+            stats['wait_max_ms'] = max(stats['wait_max_ms'], waited_ms)
+            # Let the next ticket re-check whether it's now at the head
+            self._cond.notify_all()
+
+    def throttle(self, seconds):
+        """Pause all lanes after IC2 answered 429"""
+        with self._cond:
+            self.throttled += 1
+            self.tokens = 0
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            self._refill(time.monotonic())
+            lanes = {}
+            for name, stats in zip(PRIORITY_NAMES, self.lanes):
+                lanes[name] = dict(stats, wait_avg_ms=round(stats['wait_total_ms'] / stats['sent'], 1) if stats['sent'] else 0.0,
+                                   wait_total_ms=round(stats['wait_total_ms'], 1), wait_max_ms=round(stats['wait_max_ms'], 1))
+            return {'rate': self.rate, 'burst': self.burst, 'tokens': round(self.tokens, 2),
+                    'paused_for': round(max(0.0, self.paused_until - time.monotonic()), 2),
+                    'throttled': self.throttled, 'lanes': lanes}
 
 class PeplinkAPI:
-    def __init__(self, client_id, client_secret, api_url):
+    def __init__(self, client_id, client_secret, api_url, pool_size=20, timeout=30, scheduler=None):
         self.client_id = client_id
         self.client_secret = client_secret
         self.api_url = api_url
+        self.timeout = timeout
+        self.scheduler = scheduler
         self.access_token = None
+        self.token_expires_at = 0
+        self._auth_failed_at = None
+        self._auth_lock = threading.Lock()
+        self.session = requests.Session()
+        adapter = TimedHTTPAdapter(pool_connections=2, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
     
     def authenticate(self):
+        """Fetch a new access token unconditionally"""
+        with self._auth_lock:
+            return self._fetch_token()
+
+    def _fetch_token(self):
         try:
-            response = requests.post(
+            response = self.session.post(
                 f"{self.api_url}/api/oauth2/token",
                 data={'client_id': self.client_id, 'client_secret': self.client_secret, 'grant_type': 'client_credentials'},
-                timeout=30
+                timeout=self.timeout
             )
             if response.status_code == 200:
-                self.access_token = response.json().get('access_token')
+                payload = response.json()
+                expires_in = payload.get('expires_in')
+                self.access_token = payload.get('access_token')
+                self.token_expires_at = time.monotonic() + float(expires_in) if expires_in else float('inf')
+                self._auth_failed_at = None
+                token_refreshes.inc('success')
                 print(f'[API] Authenticated successfully')
                 return True
             print(f'[API] Authentication failed: {response.status_code}')
         except Exception as e:
             print(f'[API] Authentication error: {e}')
+        token_refreshes.inc('failure')
+        self._auth_failed_at = time.monotonic()
         return False
-    
-    def get(self, endpoint):
-        if not self.access_token:
-            self.authenticate()
-        if not self.access_token:
+
+    def refresh_token(self, stale_token):
+        """Replace stale_token; concurrent callers share a single OAuth request"""
+        with span('upstream token refresh'), self._auth_lock:
+            if self.access_token != stale_token:
+                # Another thread refreshed while we waited for the lock
+                return self.access_token is not None
+            if self._auth_failed_at and time.monotonic() - self._auth_failed_at < AUTH_RETRY_DELAY:
+                return False
+            return self._fetch_token()
+
+    def ensure_token(self):
+        """Return a usable token, refreshing it shortly before it expires"""
+        token = self.access_token
+        if token and time.monotonic() < self.token_expires_at - TOKEN_REFRESH_MARGIN:
+            return token
+        self.refresh_token(token)
+        return self.access_token
+
+    def request(self, method, endpoint, data=None):
+        """Send a request to the IC2 API, returning the response or None on a transport error"""
+        token = self.ensure_token()
+        if not token:
             return None
         try:
-            response = requests.get(f"{self.api_url}{endpoint}", params={'access_token': self.access_token}, timeout=30)
-            if response.status_code == 401:
-                if self.authenticate():
-                    response = requests.get(f"{self.api_url}{endpoint}", params={'access_token': self.access_token}, timeout=30)
-            if response.status_code == 200:
-                data = response.json()
-                return data.get('data', data) if isinstance(data, dict) else data
+            response = self._send(method, endpoint, token, data)
+            if response.status_code == 401 and self.refresh_token(token):
+                response = self._send(method, endpoint, self.access_token, data)
+            # A 429 means IC2 did nothing, so it's safe to wait it out and resend any method
+            retries = 0
+            while response.status_code == 429 and retries < CONFIG['api_429_retries']:
+                retries += 1
+                delay = retry_after_seconds(response.headers.get('Retry-After'), 1.0)
+                print(f'[API] {method} {endpoint} rate limited, retrying in {delay:.1f}s')
+                if self.scheduler is not None:
+                    self.scheduler.throttle(delay)
+                else:
+                    time.sleep(delay)
+                response = self._send(method, endpoint, self.access_token, data)
+            if response.status_code == 429 and self.scheduler is not None:
+                self.scheduler.throttle(retry_after_seconds(response.headers.get('Retry-After'), 1.0))
+            return response
         except Exception as e:
-            print(f'[API] Request error: {e}')
+            upstream_errors.inc(method, upstream_template(endpoint))
+            print(f'[API] {method} {endpoint} error: {e}')
         return None
 
-    def post(self, endpoint, data=None):
-        """POST request to IC2 API"""
-        if not self.access_token:
-            self.authenticate()
-        if not self.access_token:
-            return None
-        try:
-            response = requests.post(
+    def _send(self, method, endpoint, token, data):
+        if self.scheduler is not None:
+            with span('upstream rate limit'):
+                self.scheduler.acquire()
+        trace = getattr(current_trace, 'trace', None)
+        upstream_timing.connect_ms = 0
+        started = time.perf_counter()
+        with span(f'upstream {method} {upstream_template(endpoint)}'):
+            response = self.session.request(
+                method,
                 f"{self.api_url}{endpoint}",
-                params={'access_token': self.access_token},
+                params={'access_token': token},
                 json=data,
-                timeout=30
+                headers={'X-Request-ID': trace.request_id} if trace is not None else None,
+                timeout=self.timeout
             )
-            if response.status_code == 401:
-                if self.authenticate():
-                    response = requests.post(
-                        f"{self.api_url}{endpoint}",
-                        params={'access_token': self.access_token},
-                        json=data,
-                        timeout=30
-                    )
-            if response.status_code in [200, 201]:
-                return response.json() if response.text else {'success': True}
-            print(f'[API] POST failed: {response.status_code} - {response.text}')
-        except Exception as e:
-            print(f'[API] POST error: {e}')
+            # Reading .content pulls the whole body, so total covers the transfer too
+            body = response.content
+        self.record_timing(method, endpoint, response.status_code, len(body),
+                           upstream_timing.connect_ms,
+                           response.elapsed.total_seconds() * 1000,
+                           (time.perf_counter() - started) * 1000)
+        return response
+
+    def record_timing(self, method, endpoint, status, size, connect_ms, response_ms, total_ms):
+        template = upstream_template(endpoint)
+        upstream_requests.inc(method, template, status)
+        upstream_latency.observe(total_ms / 1000, method, template)
+        upstream_bytes.inc(method, template, amount=size)
+        if total_ms >= CONFIG['api_slow_ms']:
+            print(f'[API] Slow {method} {endpoint}: {status}, {size} bytes, '
+                  f'connect {connect_ms:.0f}ms, response {response_ms:.0f}ms, total {total_ms:.0f}ms')
+
+    def get(self, endpoint):
+        response = self.request('GET', endpoint)
+        if response is not None and response.status_code == 200:
+            try:
+                data = response.json()
+                return data.get('data', data) if isinstance(data, dict) else data
+            except ValueError as e:
+                print(f'[API] Request error: {e}')
         return None
 
+    def post(self, endpoint, data=None):
+        """POST request to IC2 API"""
+        return self._write('POST', endpoint, data, [200, 201])
+
     def put(self, endpoint, data=None):
         """PUT request to IC2 API"""
-        if not self.access_token:
-            self.authenticate()
-        if not self.access_token:
+        return self._write('PUT', endpoint, data, [200, 204])
+
+    def delete(self, endpoint):
+        """DELETE request to IC2 API"""
+        return self._write('DELETE', endpoint, None, [200, 204], parse_body=False)
+
+    def _write(self, method, endpoint, data, ok_statuses, parse_body=True):
+        response = self.request(method, endpoint, data)
+        if response is None:
             return None
-        try:
-            response = requests.put(
-                f"{self.api_url}{endpoint}",
-                params={'access_token': self.access_token},
-                json=data,
-                timeout=30
-            )
-            if response.status_code == 401:
-                if self.authenticate():
-                    response = requests.put(
-                        f"{self.api_url}{endpoint}",
-                        params={'access_token': self.access_token},
-                        json=data,
-                        timeout=30
-                    )
-            if response.status_code in [200, 204]:
+        if response.status_code in ok_statuses:
+            if not parse_body:
+                return {'success': True}
+            try:
                 return response.json() if response.text else {'success': True}
-            print(f'[API] PUT failed: {response.status_code} - {response.text}')
-        except Exception as e:
-            print(f'[API] PUT error: {e}')
+            except ValueError:
+                return {'success': True}
+        print(f'[API] {method} failed: {response.status_code} - {response.text}')
         return None
 
-    def delete(self, endpoint):
-        """DELETE request to IC2 API"""
-        if not self.access_token:
-            self.authenticate()
-        if not self.access_token:
+class CacheEntry:
+    __slots__ = ('value', 'fetched_at', 'ttl', 'as_of')
+
+    def __init__(self, value, ttl, as_of=None):
+        self.value = value
+        self.fetched_at = time.monotonic()
+        self.ttl = ttl
+        # Wall-clock fetch time, reported to clients when the entry is served stale
+        self.as_of = as_of or time.time()
+
+class InventorySnapshot:
+    """Read side of the on-disk copy of cached IC2 responses, memory-mapped.
+
+    Layout (little endian): header '<8sIdI' (magic, format version, written at,
+    entry count); then per entry a '<H' key length, the key (the IC2 endpoint),
+    and '<dQIII' (fetched at, data offset, stored length, raw length, crc32);
+    then the zlib-compressed JSON bodies. Opening only parses the index, so it
+    takes milliseconds however large the fleet; bodies are decoded on first use.
+    """
+
+    MAGIC = b'IC2SNAP\x00'
+    VERSION = 1
+    HEADER = struct.Struct('<8sIdI')
+    KEY_LENGTH = struct.Struct('<H')
+    ENTRY = struct.Struct('<dQIII')
+
+    def __init__(self, path):
+        self.path = path
+        self.index = {}
+        self.written_at = None
+        self._map = None
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < self.HEADER.size:
+                raise ValueError('truncated header')
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.written_at, count = self.HEADER.unpack_from(self._map, 0)
+        if magic != self.MAGIC or version != self.VERSION:
+            raise ValueError('not a snapshot file or unsupported version')
+        position = self.HEADER.size
+        for _ in range(count):
+            (key_length,) = self.KEY_LENGTH.unpack_from(self._map, position)
+            position += self.KEY_LENGTH.size
+            key = self._map[position:position + key_length].decode()
+            position += key_length
+            fetched_at, offset, length, raw_length, crc = self.ENTRY.unpack_from(self._map, position)
+            position += self.ENTRY.size
+            if offset + length > size:
+                raise ValueError('truncated data')
+            self.index[key] = (fetched_at, offset, length, raw_length, crc)
+
+    def __contains__(self, endpoint):
+        return endpoint in self.index
+
+    def raw(self, endpoint):
+        """(fetched_at, compressed bytes, raw length, crc) for copying an entry into a new snapshot"""
+        fetched_at, offset, length, raw_length, crc = self.index[endpoint]
+        return fetched_at, self._map[offset:offset + length], raw_length, crc
+
+    def get(self, endpoint):
+        """(value, fetched_at) for an endpoint, or None"""
+        entry = self.index.get(endpoint)
+        if entry is None:
+            return None
+        fetched_at, offset, length, raw_length, crc = entry
+        data = zlib.decompress(self._map[offset:offset + length])
+        if len(data) != raw_length or zlib.crc32(data) != crc:
+            print(f'[SNAPSHOT] Corrupt entry for {endpoint}, ignoring it')
             return None
+        return json.loads(data), fetched_at
+
+    def endpoints(self):
+        return list(self.index)
+
+    @classmethod
+    def open(cls, path):
         try:
-            response = requests.delete(
-                f"{self.api_url}{endpoint}",
-                params={'access_token': self.access_token},
-                timeout=30
-            )
-            if response.status_code == 401:
-                if self.authenticate():
-                    response = requests.delete(
-                        f"{self.api_url}{endpoint}",
-                        params={'access_token': self.access_token},
-                        timeout=30
-                    )
-            if response.status_code in [200, 204]:
-                return {'success': True}
-            print(f'[API] DELETE failed: {response.status_code} - {response.text}')
-        except Exception as e:
-            print(f'[API] DELETE error: {e}')
+            return cls(path)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, struct.error) as e:
+            print(f'[SNAPSHOT] Ignoring unreadable snapshot {path}: {e}')
+            return None
+
+    @classmethod
+    def write(cls, path, entries, previous=None):
+        """Atomically write entries ({endpoint: (value, fetched_at)}), carrying over
+        any endpoints of previous that entries no longer has"""
+        blobs = []
+        for endpoint, (value, fetched_at) in entries.items():
+            data = json.dumps(value, separators=(',', ':')).encode()
+            blobs.append((endpoint, fetched_at, zlib.compress(data, 1), len(data), zlib.crc32(data)))
+        if previous is not None:
+            for endpoint in previous.endpoints():
+                if endpoint not in entries:
+                    fetched_at, blob, raw_length, crc = previous.raw(endpoint)
+                    blobs.append((endpoint, fetched_at, blob, raw_length, crc))
+        index_size = sum(cls.KEY_LENGTH.size + len(endpoint.encode()) + cls.ENTRY.size for endpoint, *_ in blobs)
+        offset = cls.HEADER.size + index_size
+        tmp = Path(str(path) + '.tmp')
+        with open(tmp, 'wb') as f:
+            f.write(cls.HEADER.pack(cls.MAGIC, cls.VERSION, time.time(), len(blobs)))
+            for endpoint, fetched_at, blob, raw_length, crc in blobs:
+                key = endpoint.encode()
+                f.write(cls.KEY_LENGTH.pack(len(key)) + key)
+                f.write(cls.ENTRY.pack(fetched_at, offset, len(blob), raw_length, crc))
+                offset += len(blob)
+            for _, _, blob, _, _ in blobs:
+                f.write(blob)
+            f.flush()
+            os.fsync(f.fileno())
+        # Readers that still map the old file keep its inode alive until they reopen
+        os.replace(tmp, path)
+        return offset
+
+class InFlight:
+    """An upstream fetch that concurrent callers for the same endpoint wait on"""
+    __slots__ = ('event', 'value', 'generation')
+
+    def __init__(self, generation):
+        self.event = threading.Event()
+        self.value = None
+        self.generation = generation
+
+class ResponseCache:
+    """LRU cache in front of PeplinkAPI.get with per-endpoint TTLs.
+
+    Entries past their TTL are still served for stale_ttl seconds while a
+    background refresh runs. Concurrent misses for one endpoint share a
+    single upstream fetch.
+    """
+
+    def __init__(self, api, rules, stale_ttl=300, max_entries=1000):
+        self.api = api
+        self.rules = [(re.compile(pattern), ttl) for pattern, ttl in rules]
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+        # On-disk copy used for warm starts and when IC2 can't be reached
+        self.snapshot = None
+        # Endpoints fetched from IC2 since startup; until then the snapshot answers misses
+        self._fetched = set()
+        # Bumped whenever an entry is stored, so the snapshot writer can skip idle periods
+        self.version = 0
+        # Called with (org_id, group_id) after a write invalidated entries
+        self.invalidate_listeners = []
+
+    def subscribe_invalidate(self, listener):
+        self.invalidate_listeners.append(listener)
+
+    def ttl_for(self, endpoint):
+        for pattern, ttl in self.rules:
+            if pattern.match(endpoint):
+                return ttl
         return None
 
-api = PeplinkAPI(CONFIG['client_id'], CONFIG['client_secret'], CONFIG['api_url'])
-sessions = {}
+    def get(self, endpoint):
+        ttl = self.ttl_for(endpoint)
+        if ttl is None:
+            return self.api.get(endpoint)
+        with self._lock:
+            entry = self._entries.get(endpoint)
+            if entry is not None:
+                self._entries.move_to_end(endpoint)
+                age = time.monotonic() - entry.fetched_at
+                if age < entry.ttl:
+                    self.hits += 1
+                    return entry.value
+                if age < entry.ttl + self.stale_ttl:
+                    self.stale_hits += 1
+                    if endpoint not in self._fetched:
+                        # Restored from the snapshot and not yet refreshed from IC2
+                        mark_stale(entry.as_of)
+                    flight, leader = self._join(endpoint)
+                    if leader:
+                        threading.Thread(target=self._refresh, args=(endpoint, ttl, flight), daemon=True).start()
+                    return entry.value
+            snapshot = self.snapshot
+            from_snapshot = snapshot is not None and endpoint not in self._fetched and endpoint in snapshot
+            if not from_snapshot:
+                self.misses += 1
+                flight, leader = self._join(endpoint)
+        if from_snapshot:
+            # Warm start: decode the snapshot copy outside the lock and refresh it in the background
+            restored = snapshot.get(endpoint)
+            if restored is not None:
+                return self._restore(endpoint, ttl, *restored)
+            with self._lock:
+                self.misses += 1
+                flight, leader = self._join(endpoint)
+        if leader:
+            self._fetch(endpoint, ttl, flight)
+        flight.event.wait()
+        if flight.value is None:
+            return self._last_known(endpoint)
+        return flight.value
+
+    def _restore(self, endpoint, ttl, value, as_of):
+        with self._lock:
+            self.stale_hits += 1
+            if endpoint not in self._entries:
+                self._store(endpoint, CacheEntry(value, ttl, as_of), expired=True)
+            flight, leader = self._join(endpoint)
+        if leader:
+            threading.Thread(target=self._refresh, args=(endpoint, ttl, flight), daemon=True).start()
+        mark_stale(as_of)
+        return value
+
+    def _last_known(self, endpoint):
+        """Expired cache entry or snapshot data for an endpoint IC2 failed to answer"""
+        with self._lock:
+            entry = self._entries.get(endpoint)
+        snapshot = self.snapshot
+        if entry is not None:
+            value, as_of = entry.value, entry.as_of
+        elif snapshot is not None and endpoint in snapshot:
+            restored = snapshot.get(endpoint)
+            if restored is None:
+                return None
+            value, as_of = restored
+        else:
+            return None
+        print(f'[CACHE] IC2 unavailable for {endpoint}, serving data from {time.time() - as_of:.0f}s ago')
+        mark_stale(as_of)
+        return value
+
+    def _store(self, endpoint, entry, expired=False):
+        # Caller holds the lock
+        if expired:
+            entry.fetched_at -= entry.ttl
+        self._entries[endpoint] = entry
+        self._entries.move_to_end(endpoint)
+        self.version += 1
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _join(self, endpoint):
+        """Return (flight, leader); only the leader performs the upstream call"""
+        flight = self._inflight.get(endpoint)
+        if flight is not None:
+            return flight, False
+        flight = InFlight(self._generation)
+        self._inflight[endpoint] = flight
+        return flight, True
+
+    def _fetch(self, endpoint, ttl, flight):
+        try:
+            flight.value = self.api.get(endpoint)
+        finally:
+            with self._lock:
+                # A write may have detached this flight and a newer one taken its place
+                if self._inflight.get(endpoint) is flight:
+                    del self._inflight[endpoint]
+                if flight.value is not None:
+                    self._fetched.add(endpoint)
+                # Skip storing results that raced with an invalidating write
+                if flight.value is not None and flight.generation == self._generation:
+                    self._store(endpoint, CacheEntry(flight.value, ttl))
+            flight.event.set()
+
+    def _refresh(self, endpoint, ttl, flight):
+        # Stale entries are still being served, so the refresh can wait behind user traffic
+        with use_priority(PRIORITY_BACKGROUND):
+            self._fetch(endpoint, ttl, flight)
+
+    def put(self, endpoint, value):
+        """Store a value fetched elsewhere, e.g. by the inventory poller"""
+        ttl = self.ttl_for(endpoint)
+        if ttl is None or value is None:
+            return
+        with self._lock:
+            self._fetched.add(endpoint)
+            self._store(endpoint, CacheEntry(value, ttl))
+
+    def fetched_at(self, endpoint):
+        """Wall-clock fetch time of the cached entry for endpoint, or None when not cached"""
+        with self._lock:
+            entry = self._entries.get(endpoint)
+            return entry.as_of if entry is not None else None
+
+    def export(self):
+        """{endpoint: (value, fetched_at)} of every cached entry, for the snapshot writer"""
+        with self._lock:
+            return {endpoint: (entry.value, entry.as_of) for endpoint, entry in self._entries.items()}
+
+    def invalidate(self, org_id, group_id=None):
+        """Drop entries a write to the given org (or one of its groups) may have changed"""
+        org_prefix = f'/rest/o/{org_id}'
+        if group_id is None:
+            scope = org_prefix + '/'
+        else:
+            scope = f'{org_prefix}/g/{group_id}'
+        def affected(endpoint):
+            return endpoint in (org_prefix + '/g', org_prefix + '/d') or endpoint.startswith(scope)
+
+        with self._lock:
+            self._generation += 1
+            for endpoint in list(self._entries):
+                if affected(endpoint):
+                    del self._entries[endpoint]
+            # Fetches started before the write may return pre-write data; later readers
+            # must not join them, so detach them and let the next miss start a new fetch
+            for endpoint in list(self._inflight):
+                if affected(endpoint):
+                    del self._inflight[endpoint]
+        for listener in self.invalidate_listeners:
+            try:
+                listener(org_id, group_id)
+            except Exception as e:
+                print(f'[CACHE] Invalidate listener error: {e}')
+
+    def invalidate_path(self, ic2_path):
+        """Invalidate whatever org/group an IC2 write path refers to"""
+        match = re.match(r'^/rest/o/([^/]+)(?:/g/([^/]+))?', ic2_path)
+        if match:
+            self.invalidate(match.group(1), match.group(2))
+
+upstream_scheduler = UpstreamScheduler(CONFIG['api_rate_limit'], CONFIG['api_burst'])
+api = PeplinkAPI(CONFIG['client_id'], CONFIG['client_secret'], CONFIG['api_url'],
+                 pool_size=CONFIG['api_pool_size'], timeout=CONFIG['api_timeout'],
+                 scheduler=upstream_scheduler)
+api_cache = ResponseCache(api, [
+    (r'^/rest/o$', CONFIG['cache_ttl_orgs']),
+    (r'^/rest/o/[^/]+/g$', CONFIG['cache_ttl_groups']),
+    (r'^/rest/o/[^/]+/d$', CONFIG['cache_ttl_devices']),
+    (r'^/rest/o/[^/]+/g/[^/]+/d$', CONFIG['cache_ttl_devices']),
+], stale_ttl=CONFIG['cache_stale_ttl'], max_entries=CONFIG['cache_max_entries'])
+DeviceChange = namedtuple('DeviceChange', 'version op org_id group_id device_id before after fields')
+
+class InventoryStore:
+    """In-memory devices keyed org -> group -> device id, with a versioned change log.
+
+    Listeners registered with subscribe() are called with (org_id, changes)
+    while the store lock is held, so they observe changes in version order.
+    Refresh listeners get (org_id, records) after every refresh, changed or not.
+    """
+
+    def __init__(self, max_changes=50000):
+        self.orgs = {}
+        self.loaded_at = {}
+        self.version = 0
+        # Version of each org's latest change, for validating responses built from one org
+        self.org_versions = {}
+        # Orgs seeded from the snapshot that the poller hasn't refreshed yet
+        self.restored = set()
+        self.changes = deque(maxlen=max_changes)
+        self.listeners = []
+        self.refresh_listeners = []
+        self._lock = threading.RLock()
+
+    def subscribe(self, listener):
+        self.listeners.append(listener)
+
+    def subscribe_refresh(self, listener):
+        self.refresh_listeners.append(listener)
+
+    def size(self):
+        """(device count, current version)"""
+        with self._lock:
+            count = sum(len(devices) for groups in self.orgs.values() for devices in groups.values())
+            return count, self.version
+
+    def has_org(self, org_id):
+        return org_id in self.orgs
+
+    def stale_since(self, max_age, org_id=None):
+        """Earliest loaded_at of the org (or of all orgs) holding snapshot data or
+        not refreshed for max_age seconds, or None when all of it is current"""
+        with self._lock:
+            org_ids = list(self.loaded_at) if org_id is None else [org_id]
+            now = time.time()
+            stale = [self.loaded_at[org] for org in org_ids if org in self.loaded_at and
+                     (org in self.restored or now - self.loaded_at[org] > max_age)]
+            return min(stale, default=None)
+
+    def org_version(self, org_id):
+        with self._lock:
+            return self.org_versions.get(org_id, 0)
+
+    def devices(self, org_id, group_id=None):
+        """Return the org's device records, optionally limited to one group"""
+        with self._lock:
+            groups = self.orgs.get(org_id, {})
+            if group_id is not None:
+                return list(groups.get(group_id, {}).values())
+            return [record for devices in groups.values() for record in devices.values()]
+
+    def replace_org(self, org_id, records, restored_at=None):
+        """Swap in a freshly fetched device list and record per-device diffs.
+
+        With restored_at (the fetch time of snapshot data) the org is only
+        seeded if nothing fresher is loaded, and refresh listeners are skipped.
+        """
+        with self._lock:
+            if restored_at is not None and org_id in self.orgs:
+                return []
+            previous = {
+                device_id: (group_id, record)
+                for group_id, devices in self.orgs.get(org_id, {}).items()
+                for device_id, record in devices.items()
+            }
+            groups = {}
+            changes = []
+            for record in records:
+                device_id = record.get('id')
+                group_id = record.get('group_id')
+                groups.setdefault(group_id, {})[device_id] = record
+                old = previous.pop(device_id, None)
+                if old is None:
+                    changes.append(self._change('add', org_id, group_id, device_id, None, record, None))
+                    continue
+                old_group_id, old_record = old
+                fields = [key for key in old_record.keys() | record.keys()
+                          if old_record.get(key) != record.get(key)]
+                if fields:
+                    changes.append(self._change('update', org_id, group_id, device_id, old_record, record, fields))
+            for device_id, (group_id, record) in previous.items():
+                changes.append(self._change('remove', org_id, group_id, device_id, record, None, None))
+            self.orgs[org_id] = groups
+            self.loaded_at[org_id] = restored_at or time.time()
+            if restored_at is not None:
+                self.restored.add(org_id)
+            else:
+                self.restored.discard(org_id)
+            self._publish(org_id, changes)
+        if restored_at is not None:
+            return changes
+        for listener in self.refresh_listeners:
+            try:
+                listener(org_id, records)
+            except Exception as e:
+                print(f'[INVENTORY] Refresh listener error: {e}')
+        return changes
+
+    def remove_org(self, org_id):
+        with self._lock:
+            if org_id not in self.orgs:
+                return
+            changes = [self._change('remove', org_id, group_id, device_id, record, None, None)
+                       for group_id, devices in self.orgs.pop(org_id).items()
+                       for device_id, record in devices.items()]
+            self.loaded_at.pop(org_id, None)
+            self.restored.discard(org_id)
+            self._publish(org_id, changes)
+            self.org_versions.pop(org_id, None)
+
+    def _change(self, op, org_id, group_id, device_id, before, after, fields):
+        self.version += 1
+        return DeviceChange(self.version, op, org_id, group_id, device_id, before, after, fields)
+
+    def _publish(self, org_id, changes):
+        if not changes:
+            return
+        self.changes.extend(changes)
+        self.org_versions[org_id] = self.version
+        for listener in self.listeners:
+            try:
+                listener(org_id, changes)
+            except Exception as e:
+                print(f'[INVENTORY] Listener error: {e}')
+
+    def changes_since(self, version):
+        """Return (current_version, changes), or (current_version, None) when the
+        requested version is older than the retained log and the client must reload"""
+        with self._lock:
+            if version >= self.version:
+                return self.version, []
+            if not self.changes or self.changes[0].version > version + 1:
+                return self.version, None
+            # Versions are contiguous, so the start offset can be computed directly
+            start = version + 1 - self.changes[0].version
+            return self.version, [self.changes[i] for i in range(start, len(self.changes))]
+
+def change_to_json(change):
+    """Client-facing form of a DeviceChange: full record on add, changed fields on update"""
+    data = {
+        'version': change.version,
+        'op': change.op,
+        'org_id': change.org_id,
+        'group_id': change.group_id,
+        'device_id': change.device_id,
+    }
+    if change.op == 'add':
+        data['device'] = change.after
+    elif change.op == 'update':
+        data['changes'] = {field: change.after.get(field) for field in change.fields}
+    return data
+
+class InventoryPoller:
+    """Background thread that refreshes every org's devices into an InventoryStore"""
+
+    def __init__(self, api, store, interval=60, jitter=0.1):
+        self.api = api
+        self.store = store
+        self.interval = interval
+        self.jitter = jitter
+        self.last_poll = None
+        # org_id -> whether another refresh was requested while one is running
+        self._refreshing = {}
+        self._refresh_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name='inventory-poller', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def next_delay(self):
+        # Jitter keeps several instances from polling IC2 in lockstep
+        return self.interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def run(self):
+        upstream_priority.lane = PRIORITY_BACKGROUND
+        while not self._stop.is_set():
+            try:
+                self.poll_once()
+            except Exception as e:
+                print(f'[INVENTORY] Poll error: {e}')
+            self._stop.wait(self.next_delay())
+
+    def refresh_org(self, org_id):
+        """Re-fetch one org's devices in the background, e.g. after a write to it.
+
+        Requests made while a refresh of the org is running coalesce into one
+        more fetch after it, so the last write is always picked up.
+        """
+        with self._refresh_lock:
+            if org_id in self._refreshing:
+                self._refreshing[org_id] = True
+                return
+            self._refreshing[org_id] = False
+        threading.Thread(target=self._refresh_org, args=(org_id,), name='inventory-refresh', daemon=True).start()
+
+    def _refresh_org(self, org_id):
+        # The write already answered its caller, so the re-fetch waits behind user requests
+        upstream_priority.lane = PRIORITY_BACKGROUND
+        endpoint = f'/rest/o/{org_id}/d'
+        while True:
+            try:
+                devices = self.api.get(endpoint)
+                if devices is not None:
+                    api_cache.put(endpoint, devices)
+                    self.store.replace_org(org_id, devices)
+            except Exception as e:
+                print(f'[INVENTORY] Refresh of {org_id} failed: {e}')
+            with self._refresh_lock:
+                if not self._refreshing[org_id]:
+                    del self._refreshing[org_id]
+                    return
+                self._refreshing[org_id] = False
+
+    def poll_once(self):
+        started = time.monotonic()
+        orgs = self.api.get('/rest/o')
+        if orgs is None:
+            print('[INVENTORY] Could not fetch organizations, keeping previous inventory')
+            return
+        api_cache.put('/rest/o', orgs)
+        seen = set()
+        changed = 0
+        for org in orgs:
+            org_id = org.get('id')
+            seen.add(org_id)
+            endpoint = f'/rest/o/{org_id}/d'
+            devices = self.api.get(endpoint)
+            if devices is None:
+                continue
+            api_cache.put(endpoint, devices)
+            changed += len(self.store.replace_org(org_id, devices))
+        for org_id in list(self.store.orgs):
+            if org_id not in seen:
+                self.store.remove_org(org_id)
+        self.last_poll = time.time()
+        print(f'[INVENTORY] Polled {len(orgs)} orgs in {time.monotonic() - started:.1f}s, '
+              f'{changed} changes, version {self.store.version}')
+
+def is_online(device):
+    return device.get('status') == 'online' or device.get('onlineStatus') == 'ONLINE'
+
+def firmware_version(device):
+    fw_ver = device.get('fw_ver')
+    return fw_ver.split(' ')[0] if fw_ver else None
+
+# Secondary index name -> (device fields it depends on, function returning its keys)
+SEARCH_INDEXES = {
+    'org': ((), None),
+    'group': (('group_id',), lambda d: [d.get('group_id')]),
+    'status': (('status', 'onlineStatus'), lambda d: ['online' if is_online(d) else 'offline']),
+    'model': (('product_name', 'model'), lambda d: [str(d.get('product_name') or d.get('model') or '').lower()]),
+    'firmware': (('fw_ver',), lambda d: [str(firmware_version(d) or '').lower()]),
+    'serial': (('sn',), lambda d: [str(d.get('sn') or '').upper()]),
+    'tag': (('tags',), lambda d: [str(tag).lower() for tag in d.get('tags') or []]),
+}
+
+# Sort field -> (value function, numeric)
+SEARCH_SORTS = {
+    'name': (lambda d: d.get('name'), False),
+    'status': (lambda d: 'online' if is_online(d) else 'offline', False),
+    'model': (lambda d: d.get('product_name') or d.get('model'), False),
+    'firmware': (firmware_version, False),
+    'serial': (lambda d: d.get('sn'), False),
+    'group': (lambda d: d.get('group_name'), False),
+    'clients': (lambda d: d.get('client_count'), True),
+    'uptime': (lambda d: d.get('uptime'), True),
+}
+
+# A change batch larger than this drops the sort orders, to be rebuilt on next use, instead of patching them
+ORDER_REBUILD_CHANGES = 1000
+# Filters matching fewer than 1/N of all devices sort their matches instead of walking a full sort order
+SELECTIVE_FILTER_RATIO = 32
+
+class DeviceIndex:
+    """Secondary indexes over the inventory for filtered, sorted, paginated search.
+
+    Devices are keyed (org_id, device_id). Inventory changes only touch the
+    indexes whose source fields changed. Each sort order is a sorted list of
+    sort entries (sort key + device key), built on first use and then kept
+    up to date, so a page is a bisect plus a short walk instead of a sort.
+    """
+
+    def __init__(self, store):
+        self.records = {}
+        self.indexes = {name: {} for name in SEARCH_INDEXES}
+        self.names = []
+        self.orders = {}
+        self._lock = threading.Lock()
+        store.subscribe(self.apply)
+
+    def apply(self, org_id, changes):
+        with self._lock:
+            if len(changes) > ORDER_REBUILD_CHANGES:
+                self.orders.clear()
+            for change in changes:
+                key = (org_id, change.device_id)
+                if self.orders:
+                    self._reorder(key, change.before, change.after)
+                if change.op == 'remove':
+                    self._unindex(key, change.before, SEARCH_INDEXES)
+                    self._remove_name(key, change.before)
+                    self.records.pop(key, None)
+                elif change.op == 'add':
+                    self.records[key] = change.after
+                    self._index(key, change.after, SEARCH_INDEXES)
+                    bisect.insort(self.names, (self._name_key(change.after), key))
+                else:
+                    fields = set(change.fields)
+                    affected = [name for name, (sources, _) in SEARCH_INDEXES.items()
+                                if fields.intersection(sources)]
+                    self._unindex(key, change.before, affected)
+                    self.records[key] = change.after
+                    self._index(key, change.after, affected)
+                    if 'name' in fields:
+                        self._remove_name(key, change.before)
+                        bisect.insort(self.names, (self._name_key(change.after), key))
+
+    def _index_keys(self, name, key, record):
+        if name == 'org':
+            return [key[0]]
+        return SEARCH_INDEXES[name][1](record)
+
+    def _index(self, key, record, names):
+        for name in names:
+            index = self.indexes[name]
+            for value in self._index_keys(name, key, record):
+                index.setdefault(value, set()).add(key)
+
+    def _unindex(self, key, record, names):
+        for name in names:
+            index = self.indexes[name]
+            for value in self._index_keys(name, key, record):
+                keys = index.get(value)
+                if keys is not None:
+                    keys.discard(key)
+                    if not keys:
+                        del index[value]
+
+    def _name_key(self, record):
+        return str(record.get('name') or '').lower()
+
+    def _remove_name(self, key, record):
+        entry = (self._name_key(record), key)
+        position = bisect.bisect_left(self.names, entry)
+        if position < len(self.names) and self.names[position] == entry:
+            del self.names[position]
+
+    def _entry(self, sort, key, record):
+        value_of, numeric = SEARCH_SORTS[sort]
+        return self._sort_key(value_of(record), numeric) + key
+
+    def _order(self, sort):
+        # Caller holds the lock
+        order = self.orders.get(sort)
+        if order is None:
+            order = self.orders[sort] = sorted(self._entry(sort, key, record) for key, record in self.records.items())
+        return order
+
+    def _reorder(self, key, before, after):
+        for sort, order in self.orders.items():
+            old = self._entry(sort, key, before) if before is not None else None
+            new = self._entry(sort, key, after) if after is not None else None
+            if old == new:
+                continue
+            if old is not None:
+                position = bisect.bisect_left(order, old)
+                if position < len(order) and order[position] == old:
+                    del order[position]
+            if new is not None:
+                bisect.insort(order, new)
+
+    def search(self, filters, name_prefix=None, sort='name', descending=False, limit=100, cursor=None):
+        """Return (page, total, next_cursor) for devices matching every filter"""
+        with self._lock:
+            candidates = []
+            for name, value in filters.items():
+                candidates.append(self.indexes[name].get(value, set()))
+            if name_prefix:
+                prefix = name_prefix.lower()
+                start = bisect.bisect_left(self.names, (prefix,))
+                matched = set()
+                for position in range(start, len(self.names)):
+                    entry_name, key = self.names[position]
+                    if not entry_name.startswith(prefix):
+                        break
+                    matched.add(key)
+                candidates.append(matched)
+            keys = None
+            if candidates:
+                candidates.sort(key=len)
+                # A single filter's index set is only read here, so it needn't be copied
+                keys = candidates[0] if len(candidates) == 1 else candidates[0].intersection(*candidates[1:])
+            total = len(self.records) if keys is None else len(keys)
+            # One extra entry tells whether there is a next page
+            wanted = limit + 1
+            if keys is not None and len(keys) * SELECTIVE_FILTER_RATIO < len(self.records):
+                entries = [self._entry(sort, key, self.records[key]) for key in keys]
+                if descending:
+                    entries = [entry for entry in entries if cursor is None or entry < cursor]
+                    page = heapq.nlargest(wanted, entries)
+                else:
+                    entries = [entry for entry in entries if cursor is None or entry > cursor]
+                    page = heapq.nsmallest(wanted, entries)
+            else:
+                order = self._order(sort)
+                page = []
+                if descending:
+                    position = (bisect.bisect_left(order, cursor) if cursor is not None else len(order)) - 1
+                    step = -1
+                else:
+                    position = bisect.bisect_right(order, cursor) if cursor is not None else 0
+                    step = 1
+                while 0 <= position < len(order) and len(page) < wanted:
+                    entry = order[position]
+                    if keys is None or entry[-2:] in keys:
+                        page.append(entry)
+                    position += step
+            has_more = len(page) > limit
+            page = page[:limit]
+            next_cursor = page[-1] if page and has_more else None
+            return [self.records[entry[-2:]] for entry in page], total, next_cursor
+
+    @staticmethod
+    def _sort_key(value, numeric):
+        # Missing values sort last; the (org_id, device_id) suffix keeps keys unique
+        if value is None or value == '':
+            return (1, 0 if numeric else '')
+        if numeric:
+            try:
+                return (0, float(value))
+            except (TypeError, ValueError):
+                return (1, 0)
+        return (0, str(value).lower())
+
+# Summary breakdown name -> (device fields it depends on, function returning the device's bucket)
+SUMMARY_DIMENSIONS = {
+    'model': (('product_name', 'model'), lambda d: d.get('product_name') or d.get('model') or 'unknown'),
+    'firmware': (('fw_ver',), lambda d: firmware_version(d) or 'unknown'),
+}
+# Fields whose change can move a device between summary counters
+SUMMARY_FIELDS = {'status', 'onlineStatus', 'group_id'}.union(
+    *(sources for sources, _ in SUMMARY_DIMENSIONS.values()))
+
+class FleetSummary:
+    """Online/offline device counts across the fleet, by org, group, model and firmware.
+
+    Counters are adjusted from inventory changes, so an update costs a few
+    dict operations and reading the summary never scans devices. The encoded
+    response is cached until the next change.
+    """
+
+    def __init__(self, store):
+        self.total = [0, 0]
+        self.orgs = {}
+        self.groups = {}
+        self.group_names = {}
+        self.dimensions = {name: {} for name in SUMMARY_DIMENSIONS}
+        self.version = 0
+        self._encoded = None
+        # Versions restart with the process, so ETags carry a per-process prefix
+        self._etag_prefix = secrets.token_hex(4)
+        self._lock = threading.Lock()
+        store.subscribe(self.apply)
+
+    def apply(self, org_id, changes):
+        with self._lock:
+            for change in changes:
+                if change.op == 'update' and not SUMMARY_FIELDS.intersection(change.fields):
+                    continue
+                if change.before is not None:
+                    self._count(org_id, change.before, -1)
+                if change.after is not None:
+                    self._count(org_id, change.after, 1)
+                self.version += 1
+            self._encoded = None
+
+    def _count(self, org_id, device, delta):
+        # Buckets are [online, offline]; emptied ones are dropped so removed groups don't linger
+        column = 0 if is_online(device) else 1
+        group_key = (org_id, device.get('group_id'))
+        if delta > 0 and device.get('group_name'):
+            self.group_names[group_key] = device['group_name']
+        buckets = [(self.orgs, org_id), (self.groups, group_key)]
+        buckets += [(self.dimensions[name], bucket_of(device)) for name, (_, bucket_of) in SUMMARY_DIMENSIONS.items()]
+        self.total[column] += delta
+        for counters, key in buckets:
+            bucket = counters.get(key)
+            if bucket is None:
+                bucket = counters[key] = [0, 0]
+            bucket[column] += delta
+            if bucket == [0, 0]:
+                del counters[key]
+                if counters is self.groups:
+                    self.group_names.pop(key, None)
+
+    def group_counts(self, org_id, group_id):
+        """(online, offline) devices in a group"""
+        with self._lock:
+            return tuple(self.groups.get((org_id, group_id), (0, 0)))
+
+    def encoded(self):
+        """(JSON body, ETag) of the current summary"""
+        with self._lock:
+            if self._encoded is None:
+                body = json.dumps(self._summary()).encode()
+                self._encoded = (body, f'"summary-{self._etag_prefix}-{self.version}"')
+            return self._encoded
+
+    def _summary(self):
+        def counts(bucket):
+            return {'devices': bucket[0] + bucket[1], 'online': bucket[0], 'offline': bucket[1]}
+        orgs = {org_id: dict(counts(bucket), groups={}) for org_id, bucket in self.orgs.items()}
+        for (org_id, group_id), bucket in self.groups.items():
+            orgs[org_id]['groups'][str(group_id)] = dict(counts(bucket), name=self.group_names.get((org_id, group_id)))
+        summary = {'version': self.version, 'total': counts(self.total), 'orgs': orgs}
+        for name, counters in self.dimensions.items():
+            summary[name] = {str(key): counts(bucket) for key, bucket in sorted(counters.items(), key=lambda item: str(item[0]))}
+        return summary
+
+def parse_fields(query):
+    """Field names requested with ?fields=a,b,c, or None for whole records"""
+    value = query.get('fields', [''])[0]
+    fields = [field.strip() for field in value.split(',') if field.strip()]
+    return fields or None
+
+def project(records, fields):
+    """Yield records reduced to the requested fields (all fields when fields is None)"""
+    if fields is None:
+        yield from records
+        return
+    for record in records:
+        yield {field: record[field] for field in fields if field in record}
+
+def json_array_chunks(items):
+    """Serialize an iterable as a JSON array one element at a time"""
+    yield '['
+    first = True
+    for item in items:
+        yield json.dumps(item) if first else ', ' + json.dumps(item)
+        first = False
+    yield ']'
+
+def tree_chunks(tree, device_fields=None):
+    """Serialize build_tree() output, streaming each org's device list"""
+    yield '{"orgs": ['
+    for i, node in enumerate(tree):
+        if 'devices' not in node:
+            yield (', ' if i else '') + json.dumps(node)
+            continue
+        head = {key: value for key, value in node.items() if key != 'devices'}
+        # Reopen the object so the devices array can be appended to it
+        yield (', ' if i else '') + json.dumps(head)[:-1] + ', "devices": '
+        yield from json_array_chunks(project(node['devices'], device_fields))
+        yield '}'
+    yield ']}'
+
+def encode_cursor(sort_key):
+    return base64.urlsafe_b64encode(json.dumps(sort_key).encode()).decode()
+
+def decode_cursor(token):
+    return tuple(json.loads(base64.urlsafe_b64decode(token.encode())))
+
+inventory = InventoryStore(max_changes=CONFIG['inventory_max_changes'])
+device_index = DeviceIndex(inventory)
+fleet_summary = FleetSummary(inventory)
+poller = InventoryPoller(api, inventory, interval=CONFIG['poll_interval'], jitter=CONFIG['poll_jitter'])
+
+def refresh_after_write(org_id, group_id):
+    # Polled orgs are read from the inventory, which cache invalidation doesn't reach
+    if inventory.has_org(org_id):
+        poller.refresh_org(org_id)
+
+api_cache.subscribe_invalidate(refresh_after_write)
+
+class SnapshotWriter:
+    """Keeps an InventorySnapshot of the IC2 response cache on disk.
+
+    restore() maps the last snapshot into the cache, so the first requests
+    after a restart are answered (marked stale) without waiting on IC2, and
+    seeds the inventory from it in the background when the poller will
+    refresh it. The writer thread then
+    rewrites the file every interval seconds when the cache has changed.
+    """
+
+    def __init__(self, path, cache, store, interval=300):
+        self.path = path
+        self.cache = cache
+        self.store = store
+        self.interval = interval
+        self.written_version = None
+        self.last_write = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def restore(self, seed=True):
+        started = time.perf_counter()
+        snapshot = InventorySnapshot.open(self.path)
+        if snapshot is None:
+            return
+        self.cache.snapshot = snapshot
+        age = time.time() - snapshot.written_at
+        print(f'[SNAPSHOT] Loaded {len(snapshot.index)} endpoints written {age:.0f}s ago '
+              f'in {(time.perf_counter() - started) * 1000:.1f}ms')
+        if seed:
+            threading.Thread(target=self.seed, args=(snapshot,), name='snapshot-seed', daemon=True).start()
+
+    def seed(self, snapshot):
+        """Load the snapshot's device lists into the inventory unless the poller got there first"""
+        started = time.monotonic()
+        count = 0
+        for endpoint in snapshot.endpoints():
+            match = re.match(r'^/rest/o/([^/]+)/d$', endpoint)
+            restored = snapshot.get(endpoint) if match else None
+            if restored is not None:
+                devices, as_of = restored
+                count += len(self.store.replace_org(match.group(1), devices, restored_at=as_of))
+        print(f'[SNAPSHOT] Seeded inventory with {count} devices in {time.monotonic() - started:.1f}s')
+
+    def start(self):
+        threading.Thread(target=self.run, name='snapshot-writer', daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+
+    def run(self):
+        while not self._stop.wait(self.interval):
+            self.write()
+
+    def write(self):
+        """Write a new snapshot if the cache changed since the last one"""
+        with self._lock:
+            version = self.cache.version
+            if version == self.written_version:
+                return
+            entries = self.cache.export()
+            if not entries:
+                return
+            started = time.perf_counter()
+            try:
+                size = InventorySnapshot.write(self.path, entries, self.cache.snapshot)
+            except OSError as e:
+                print(f'[SNAPSHOT] Write failed: {e}')
+                return
+            self.cache.snapshot = InventorySnapshot.open(self.path)
+            self.written_version = version
+            self.last_write = time.time()
+            print(f'[SNAPSHOT] Wrote {len(entries)} endpoints ({size / 1024:.0f} KB) '
+                  f'in {(time.perf_counter() - started) * 1000:.0f}ms')
+
+snapshot_writer = SnapshotWriter(SNAPSHOT_FILE, api_cache, inventory, interval=CONFIG['snapshot_interval'])
+
+class EventBroker:
+    """Fans Server-Sent Events out to many clients from a single thread.
+
+    Request handlers hand over their socket after writing the response
+    headers. Each event is encoded once and appended to every client's
+    outgoing buffer; clients whose buffer exceeds max_buffer are dropped so
+    a slow consumer never holds up the others.
+    """
+
+    def __init__(self, backlog=1000, max_buffer=256 * 1024, heartbeat=15):
+        self.backlog = deque(maxlen=backlog)
+        self.max_buffer = max_buffer
+        self.heartbeat = heartbeat
+        self.last_id = 0
+        # Event ids are "<epoch>-<n>" so a client resuming with an id from an earlier process is told to resync
+        self.epoch = secrets.token_hex(4)
+        self.clients = {}
+        self._lock = threading.Lock()
+        self._selector = selectors.DefaultSelector()
+        self._wake_reader, self._wake_writer = socket.socketpair()
+        self._wake_reader.setblocking(False)
+        self._wake_writer.setblocking(False)
+        self._selector.register(self._wake_reader, selectors.EVENT_READ)
+
+    def start(self):
+        threading.Thread(target=self.run, name='event-broker', daemon=True).start()
+
+    def publish(self, event_type, data):
+        with self._lock:
+            self.last_id += 1
+            payload = f'id: {self.epoch}-{self.last_id}\nevent: {event_type}\ndata: {json.dumps(data)}\n\n'.encode()
+            self.backlog.append((self.last_id, payload))
+            for buffer in self.clients.values():
+                buffer += payload
+        self._wake()
+
+    def add_client(self, sock, last_event_id=None):
+        """Take ownership of sock, replaying events after last_event_id (the client's Last-Event-ID)"""
+        sock.setblocking(False)
+        buffer = bytearray(b'retry: 5000\n\n')
+        with self._lock:
+            if last_event_id:
+                epoch, _, number = last_event_id.rpartition('-')
+                if epoch != self.epoch or not number.isdigit():
+                    # The id is from before a restart, so there is nothing to replay from
+                    buffer += b'event: resync\ndata: {}\n\n'
+                else:
+                    last = int(number)
+                    if self.backlog and self.backlog[0][0] > last + 1:
+                        # Events were lost while the client was away; it must reload
+                        buffer += b'event: resync\ndata: {}\n\n'
+                    for event_id, payload in self.backlog:
+                        if event_id > last:
+                            buffer += payload
+            self.clients[sock] = buffer
+        self._wake()
+
+    def _wake(self):
+        try:
+            self._wake_writer.send(b'\0')
+        except (BlockingIOError, OSError):
+            pass
+
+    def _drop(self, sock):
+        self.clients.pop(sock, None)
+        try:
+            self._selector.unregister(sock)
+        except (KeyError, ValueError):
+            pass
+        try:
+            sock.close()
+        except OSError:
+            pass
+
+    def run(self):
+        next_heartbeat = time.monotonic() + self.heartbeat
+        while True:
+            with self._lock:
+                if time.monotonic() >= next_heartbeat:
+                    next_heartbeat = time.monotonic() + self.heartbeat
+                    for buffer in self.clients.values():
+                        if not buffer:
+                            buffer += b': ping\n\n'
+                for sock, buffer in list(self.clients.items()):
+                    if len(buffer) > self.max_buffer:
+                        print('[EVENTS] Dropping slow client')
+                        self._drop(sock)
+                        continue
+                    if buffer:
+                        try:
+                            sent = sock.send(buffer)
+                            del buffer[:sent]
+                        except BlockingIOError:
+                            pass
+                        except OSError:
+                            self._drop(sock)
+                            continue
+                    interest = selectors.EVENT_READ | (selectors.EVENT_WRITE if buffer else 0)
+                    try:
+                        self._selector.modify(sock, interest)
+                    except KeyError:
+                        self._selector.register(sock, interest)
+            timeout = max(0, next_heartbeat - time.monotonic())
+            for key, mask in self._selector.select(timeout):
+                sock = key.fileobj
+                if sock is self._wake_reader:
+                    try:
+                        while sock.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                elif mask & selectors.EVENT_READ:
+                    # Clients never send on an event stream, so readable means closed
+                    try:
+                        closed = not sock.recv(4096)
+                    except BlockingIOError:
+                        closed = False
+                    except OSError:
+                        closed = True
+                    if closed:
+                        with self._lock:
+                            self._drop(sock)
+
+event_broker = EventBroker(backlog=CONFIG['sse_backlog'],
+                           max_buffer=CONFIG['sse_max_buffer_kb'] * 1024,
+                           heartbeat=CONFIG['sse_heartbeat'])
+
+# Device fields that make up its online status
+STATUS_FIELDS = ('status', 'onlineStatus')
+group_counts = {}
+
+def publish_inventory_events(org_id, changes):
+    """Turn inventory changes into device status and group counter events"""
+    # Called under the store lock. When every device in the org is an add, this is the org's
+    # first load: one event per device would flood every client, so only counters are sent.
+    first_load = (all(change.op == 'add' for change in changes) and
+                  len(changes) == sum(len(devices) for devices in inventory.orgs.get(org_id, {}).values()))
+    touched_groups = set()
+    for change in changes:
+        touched_groups.add(change.group_id)
+        if first_load:
+            continue
+        if change.op == 'update':
+            if change.before.get('group_id') != change.group_id:
+                touched_groups.add(change.before.get('group_id'))
+            if not set(change.fields).intersection(STATUS_FIELDS):
+                continue
+        event = {'op': change.op, 'org_id': org_id, 'group_id': change.group_id, 'device_id': change.device_id}
+        if change.op == 'add':
+            event['device'] = change.after
+        elif change.op == 'update':
+            event['changes'] = {field: change.after.get(field) for field in STATUS_FIELDS if field in change.after}
+        event_broker.publish('device', event)
+    for group_id in touched_groups:
+        # fleet_summary subscribed first, so its counters already include these changes
+        counts = fleet_summary.group_counts(org_id, group_id)
+        if group_counts.get((org_id, group_id)) != counts:
+            group_counts[(org_id, group_id)] = counts
+            event_broker.publish('group', {
+                'org_id': org_id,
+                'group_id': group_id,
+                'online_device_count': counts[0],
+                'offline_device_count': counts[1],
+            })
+
+inventory.subscribe(publish_inventory_events)
+
+# Rollup tables and their bucket width in seconds
+HISTORY_ROLLUPS = (('rollup_5m', 300), ('rollup_1h', 3600), ('rollup_1d', 86400))
+HISTORY_RESOLUTIONS = {'5m': 'rollup_5m', '1h': 'rollup_1h', '1d': 'rollup_1d'}
+
+class HistoryStore:
+    """Append-only device status/usage history in SQLite (WAL mode).
+
+    Every inventory refresh adds one raw sample per device and folds it into
+    5 minute, 1 hour and 1 day rollups in the same transaction. Writes go through a
+    single writer thread; readers use their own per-thread connections.
+    """
+
+    def __init__(self, path, raw_retention, retention_5m, retention_1h, retention_1d):
+        self.path = path
+        self.retention = {'samples': raw_retention, 'rollup_5m': retention_5m,
+                          'rollup_1h': retention_1h, 'rollup_1d': retention_1d}
+        self.device_ids = {}
+        self.pending = queue.Queue(maxsize=100)
+        self._local = threading.local()
+        self._last_prune = 0
+        db = self.connect()
+        db.executescript('''
+            CREATE TABLE IF NOT EXISTS devices (
+                id INTEGER PRIMARY KEY, org_id TEXT NOT NULL, device_id TEXT NOT NULL,
+                UNIQUE (org_id, device_id));
+            CREATE TABLE IF NOT EXISTS samples (
+                device INTEGER NOT NULL, ts INTEGER NOT NULL, online INTEGER NOT NULL, clients INTEGER NOT NULL,
+                PRIMARY KEY (device, ts)) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS rollup_5m (
+                device INTEGER NOT NULL, bucket INTEGER NOT NULL, samples INTEGER NOT NULL,
+                online INTEGER NOT NULL, clients_sum INTEGER NOT NULL, clients_max INTEGER NOT NULL,
+                PRIMARY KEY (device, bucket)) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS rollup_1h (
+                device INTEGER NOT NULL, bucket INTEGER NOT NULL, samples INTEGER NOT NULL,
+                online INTEGER NOT NULL, clients_sum INTEGER NOT NULL, clients_max INTEGER NOT NULL,
+                PRIMARY KEY (device, bucket)) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS rollup_1d (
+                device INTEGER NOT NULL, bucket INTEGER NOT NULL, samples INTEGER NOT NULL,
+                online INTEGER NOT NULL, clients_sum INTEGER NOT NULL, clients_max INTEGER NOT NULL,
+                PRIMARY KEY (device, bucket)) WITHOUT ROWID;
+        ''')
+        for row_id, org_id, device_id in db.execute('SELECT id, org_id, device_id FROM devices'):
+            self.device_ids[(org_id, device_id)] = row_id
+
+    def connect(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self._local.db = db
+        return db
+
+    def start(self):
+        threading.Thread(target=self.run, name='history-writer', daemon=True).start()
+
+    def record(self, org_id, records):
+        """Queue one sample per device; called after every inventory refresh"""
+        samples = [(str(record.get('id')), 1 if is_online(record) else 0, int(record.get('client_count') or 0))
+                   for record in records]
+        try:
+            self.pending.put_nowait((org_id, int(time.time()), samples))
+        except queue.Full:
+            print('[HISTORY] Writer is behind, dropping samples')
+
+    def run(self):
+        while True:
+            org_id, ts, samples = self.pending.get()
+            try:
+                self.write(org_id, ts, samples)
+                if time.time() - self._last_prune > 3600:
+                    self.prune()
+            except sqlite3.Error as e:
+                print(f'[HISTORY] Write failed: {e}')
+
+    def write(self, org_id, ts, samples):
+        db = self.connect()
+        with db:
+            rows = []
+            for device_id, online, clients in samples:
+                row_id = self.device_ids.get((org_id, device_id))
+                if row_id is None:
+                    cursor = db.execute('INSERT OR IGNORE INTO devices (org_id, device_id) VALUES (?, ?)',
+                                        (org_id, device_id))
+                    # An ignored insert leaves lastrowid at the connection's previous insert
+                    if cursor.rowcount == 1:
+                        row_id = cursor.lastrowid
+                    else:
+                        row_id = db.execute('SELECT id FROM devices WHERE org_id = ? AND device_id = ?',
+                                            (org_id, device_id)).fetchone()[0]
+                    self.device_ids[(org_id, device_id)] = row_id
+                rows.append((row_id, online, clients))
+            db.executemany('INSERT OR REPLACE INTO samples VALUES (?, ?, ?, ?)',
+                           [(row_id, ts, online, clients) for row_id, online, clients in rows])
+            for table, width in HISTORY_ROLLUPS:
+                bucket = ts - ts % width
+                db.executemany(f'''
+                    INSERT INTO {table} VALUES (?, ?, 1, ?, ?, ?)
+                    ON CONFLICT (device, bucket) DO UPDATE SET
+                        samples = samples + 1,
+                        online = online + excluded.online,
+                        clients_sum = clients_sum + excluded.clients_sum,
+                        clients_max = max(clients_max, excluded.clients_max)
+                ''', [(row_id, bucket, online, clients, clients) for row_id, online, clients in rows])
+
+    def prune(self):
+        self._last_prune = time.time()
+        db = self.connect()
+        with db:
+            for table, retention in self.retention.items():
+                column = 'ts' if table == 'samples' else 'bucket'
+                db.execute(f'DELETE FROM {table} WHERE {column} < ?', (int(time.time() - retention),))
+
+    def query(self, org_id, device_id, start, end, resolution='auto'):
+        """Points between start and end as [ts, online_ratio, clients_avg, clients_max]"""
+        if resolution == 'auto':
+            span = end - start
+            if span <= 6 * 3600:
+                resolution = 'raw'
+            elif span <= 7 * 86400:
+                resolution = '5m'
+            elif span <= 90 * 86400:
+                resolution = '1h'
+            else:
+                resolution = '1d'
+        row_id = self.device_ids.get((org_id, str(device_id)))
+        result = {'org_id': org_id, 'device_id': device_id, 'from': start, 'to': end,
+                  'resolution': resolution, 'points': []}
+        if row_id is None:
+            return result
+        db = self.connect()
+        if resolution == 'raw':
+            rows = db.execute('SELECT ts, online, clients, clients, 1 FROM samples '
+                              'WHERE device = ? AND ts BETWEEN ? AND ? ORDER BY ts',
+                              (row_id, start, end)).fetchall()
+        elif resolution in HISTORY_RESOLUTIONS:
+            table = HISTORY_RESOLUTIONS[resolution]
+            rows = db.execute(f'SELECT bucket, online, clients_sum, clients_max, samples FROM {table} '
+                              'WHERE device = ? AND bucket BETWEEN ? AND ? ORDER BY bucket',
+                              (row_id, start, end)).fetchall()
+        else:
+            raise ValueError('resolution must be auto, raw, 5m, 1h or 1d')
+        samples = sum(row[4] for row in rows)
+        online = sum(row[1] for row in rows)
+        result['points'] = [[ts, round(up / n, 3), round(total / n, 1), peak] for ts, up, total, peak, n in rows]
+        result['availability'] = round(online / samples, 4) if samples else None
+        return result
+
+    def availability(self, org_id, start, end):
+        """Fraction of samples each of an org's devices was online in [start, end].
+
+        Whole days come from the daily rollup and the partial days at either
+        end from the hourly one, keeping the rows read per device small.
+        """
+        start -= start % 3600
+        first_day = start + (-start) % 86400
+        last_day = end - end % 86400
+        if first_day < last_day:
+            ranges = [('rollup_1d', first_day, last_day - 1),
+                      ('rollup_1h', start, first_day - 1),
+                      ('rollup_1h', last_day, end)]
+        else:
+            ranges = [('rollup_1h', start, end)]
+        totals = {}
+        db = self.connect()
+        for table, low, high in ranges:
+            if low > high:
+                continue
+            rows = db.execute(f'''
+                SELECT d.device_id, sum(r.online), sum(r.samples)
+                FROM devices d JOIN {table} r ON r.device = d.id
+                WHERE d.org_id = ? AND r.bucket BETWEEN ? AND ?
+                GROUP BY d.id
+            ''', (org_id, low, high))
+            for device_id, online, samples in rows:
+                previous = totals.get(device_id, (0, 0))
+                totals[device_id] = (previous[0] + online, previous[1] + samples)
+        return {device_id: round(online / samples, 4) for device_id, (online, samples) in totals.items() if samples}
+
+history = None
+if CONFIG['history_enabled']:
+    history = HistoryStore(HISTORY_DB_FILE,
+                           raw_retention=CONFIG['history_raw_hours'] * 3600,
+                           retention_5m=CONFIG['history_5m_days'] * 86400,
+                           retention_1h=CONFIG['history_1h_days'] * 86400,
+                           retention_1d=CONFIG['history_1d_days'] * 86400)
+    inventory.subscribe_refresh(history.record)
+
+def history_range(query):
+    """(start, end) epoch seconds from ?from=&to= or ?range=24h/7d, defaulting to the last day"""
+    end = int(query.get('to', [time.time()])[0])
+    if 'from' in query:
+        return int(query['from'][0]), end
+    span = query.get('range', ['24h'])[0]
+    units = {'h': 3600, 'd': 86400}
+    if not span or span[-1] not in units:
+        raise ValueError('range must look like 6h or 30d')
+    return end - int(float(span[:-1]) * units[span[-1]]), end
+
+def search_devices(query):
+    """Run a /api/devices/search query string against the device index"""
+    filters = {}
+    for name in SEARCH_INDEXES:
+        value = query.get(name, [None])[0]
+        if value is None or value == '':
+            continue
+        if name == 'group':
+            value = int(value) if value.isdigit() else value
+        elif name == 'serial':
+            value = value.upper()
+        elif name != 'org':
+            value = value.lower()
+        filters[name] = value
+    sort = query.get('sort', ['name'])[0]
+    if sort not in SEARCH_SORTS:
+        raise ValueError(f'sort must be one of: {", ".join(SEARCH_SORTS)}')
+    limit = max(1, min(int(query.get('limit', ['100'])[0]), 1000))
+    cursor = query.get('cursor', [None])[0]
+    with span('search'):
+        devices, total, next_cursor = device_index.search(
+            filters,
+            name_prefix=query.get('name', [None])[0],
+            sort=sort,
+            descending=query.get('order', ['asc'])[0] == 'desc',
+            limit=limit,
+            cursor=decode_cursor(cursor) if cursor else None,
+        )
+    return {
+        'devices': devices,
+        'total': total,
+        'next_cursor': encode_cursor(next_cursor) if next_cursor else None,
+        'inventory_version': inventory.version,
+    }
+
+def mark_inventory_stale(org_id=None):
+    # Restored from the snapshot, or the poller has been failing to refresh it
+    stale_since = inventory.stale_since(CONFIG['poll_interval'] * 2, org_id)
+    if stale_since is not None:
+        mark_stale(stale_since)
+
+def org_devices(org_id):
+    """Devices for an org from the polled inventory, falling back to the IC2 cache"""
+    if inventory.has_org(org_id):
+        mark_inventory_stale(org_id)
+        return inventory.devices(org_id)
+    return api_cache.get(f'/rest/o/{org_id}/d')
+
+def group_devices(org_id, group_id):
+    """Devices in one group, without downloading the rest of the org when it isn't polled"""
+    if inventory.has_org(org_id):
+        # The inventory keys groups by IC2's numeric id
+        try:
+            key = int(group_id)
+        except ValueError:
+            key = group_id
+        mark_inventory_stale(org_id)
+        return inventory.devices(org_id, key)
+    return api_cache.get(f'/rest/o/{org_id}/g/{group_id}/d')
+
+def devices_etag(path, org_id, group_id=None):
+    """ETag for a device list response, from the version of the data it will be read from.
+
+    None when the list isn't cached yet, in which case the body is hashed instead.
+    """
+    if inventory.has_org(org_id):
+        return validator_etag(path, 'inventory', inventory.org_version(org_id))
+    endpoint = f'/rest/o/{org_id}/d' if group_id is None else f'/rest/o/{org_id}/g/{group_id}/d'
+    fetched_at = api_cache.fetched_at(endpoint)
+    return validator_etag(path, 'cache', fetched_at) if fetched_at is not None else None
+
+# Shared by all requests so the total number of parallel upstream calls stays bounded
+fanout_pool = ThreadPoolExecutor(max_workers=CONFIG['fanout_workers'], thread_name_prefix='fanout')
+
+def with_lock_status(org_id, groups):
+    """Return copies of groups carrying their locked flag"""
+    locked = locked_groups.snapshot()
+    return [dict(group, locked=locked.get(f"{org_id}-{group.get('id')}", False))
+            for group in groups]
+
+def build_tree(include_devices=True):
+    """Fetch every org's groups (and devices) in parallel and merge them into one tree"""
+    orgs = api_cache.get('/rest/o')
+    if orgs is None:
+        return None
+    pending = []
+    for org in orgs:
+        org_id = org.get('id')
+        pending.append((
+            org,
+            fanout_pool.submit(traced(api_cache.get), f'/rest/o/{org_id}/g'),
+            fanout_pool.submit(traced(org_devices), org_id) if include_devices else None,
+        ))
+    tree = []
+    for org, groups_future, devices_future in pending:
+        groups = groups_future.result()
+        node = dict(org, groups=with_lock_status(org.get('id'), groups or []))
+        results = [('groups', groups)]
+        if devices_future is not None:
+            node['devices'] = devices_future.result() or []
+            results.append(('devices', devices_future.result()))
+        failed = [name for name, value in results if value is None]
+        if failed:
+            node['error'] = f"Failed to load {' and '.join(failed)}"
+        tree.append(node)
+    return tree
+
+BATCH_METHODS = ('POST', 'PUT', 'DELETE')
+# Upstream statuses meaning the request was not acted on, so any method can be retried
+BATCH_RETRY_ALWAYS = (429, 503)
+# Statuses (and transport errors) where a write may or may not have landed; only idempotent methods retry
+BATCH_RETRY_IDEMPOTENT = (None, 502, 504)
+GROUP_PATH = re.compile(r'^/rest/o/([^/]+)/g/([^/]+)')
+DEVICE_PATH = re.compile(r'^/rest/o/([^/]+)/d/([^/]+)')
+
+batch_pool = ThreadPoolExecutor(max_workers=CONFIG['batch_workers'], thread_name_prefix='batch')
+
+def parse_batch(data):
+    """Validate a batch request body into (operations, parallelism), or raise ValueError"""
+    operations = data.get('operations') if isinstance(data, dict) else None
+    if not isinstance(operations, list) or not operations:
+        raise ValueError('operations must be a non-empty list')
+    if len(operations) > CONFIG['batch_max_operations']:
+        raise ValueError(f"At most {CONFIG['batch_max_operations']} operations per batch")
+    parsed = []
+    for index, op in enumerate(operations):
+        if not isinstance(op, dict):
+            raise ValueError(f'Operation {index} must be an object')
+        method = str(op.get('method', '')).upper()
+        path = op.get('path')
+        if method not in BATCH_METHODS:
+            raise ValueError(f'Operation {index}: method must be one of {", ".join(BATCH_METHODS)}')
+        if not isinstance(path, str) or not path.startswith('/'):
+            raise ValueError(f'Operation {index}: path is required')
+        # Accept the same paths the single-call proxy takes, with or without the /api/ic2 prefix
+        if path.startswith('/api/ic2/'):
+            path = path[len('/api/ic2'):]
+        parsed.append({'index': index, 'id': op.get('id'), 'method': method,
+                       'path': '/rest' + path, 'data': op.get('data')})
+    try:
+        parallelism = int(data.get('parallelism') or CONFIG['batch_workers'])
+    except (TypeError, ValueError):
+        raise ValueError('parallelism must be a number')
+    return parsed, max(1, min(parallelism, CONFIG['batch_workers']))
+
+def locked_targets(operations):
+    """Indexes of operations that touch a locked group, directly or through one of its devices"""
+    locked = locked_groups.snapshot()
+    device_groups = {}
+    refused = set()
+    for op in operations:
+        match = GROUP_PATH.match(op['path'])
+        if match:
+            org_id, group_id = match.groups()
+        else:
+            match = DEVICE_PATH.match(op['path'])
+            if not match:
+                continue
+            org_id, device_id = match.groups()
+            if org_id not in device_groups:
+                device_groups[org_id] = {str(d.get('id')): d.get('group_id') for d in org_devices(org_id) or []}
+            group_id = device_groups[org_id].get(device_id)
+        if locked.get(f'{org_id}-{group_id}'):
+            refused.add(op['index'])
+    return refused
+
+def run_batch_operation(op):
+    """Send one batch operation, retrying transient failures with exponential backoff"""
+    attempts = 0
+    while True:
+        attempts += 1
+        with use_priority(PRIORITY_BULK):
+            response = api.request(op['method'], op['path'], op['data'])
+        status = response.status_code if response is not None else None
+        retryable = status in BATCH_RETRY_ALWAYS or (op['method'] != 'POST' and status in BATCH_RETRY_IDEMPOTENT)
+        if not retryable or attempts > CONFIG['batch_retries']:
+            break
+        delay = CONFIG['batch_retry_delay'] * 2 ** (attempts - 1)
+        if response is not None:
+            delay = max(delay, retry_after_seconds(response.headers.get('Retry-After'), 0))
+        time.sleep(delay * random.uniform(1, 1.5))
+    api_cache.invalidate_path(op['path'])
+    result = {'index': op['index'], 'id': op['id'], 'status': status, 'attempts': attempts,
+              'ok': status is not None and 200 <= status < 300}
+    if response is None:
+        result['error'] = 'IC2 API request failed'
+    elif response.content:
+        try:
+            result['result' if result['ok'] else 'error'] = response.json()
+        except ValueError:
+            result['result' if result['ok'] else 'error'] = response.text[:500]
+    return result
+
+def run_batch(operations, parallelism):
+    """Yield one result per operation as it completes, with at most parallelism in flight"""
+    refused = locked_targets(operations)
+    pending = deque()
+    for op in operations:
+        if op['index'] in refused:
+            yield {'index': op['index'], 'id': op['id'], 'status': 423, 'attempts': 0, 'ok': False,
+                   'error': 'Group is locked'}
+        else:
+            pending.append(op)
+    running = set()
+    run_operation = traced(run_batch_operation)
+    while pending or running:
+        while pending and len(running) < parallelism:
+            running.add(batch_pool.submit(run_operation, pending.popleft()))
+        done, running = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            yield future.result()
+
+def session_key(session_id):
+    # Only a hash of the cookie value is persisted, so a leaked sessions file can't be replayed
+    return hashlib.sha256(session_id.encode()).hexdigest()
+
+def session_expired(key, session):
+    return time.time() - session.get('created', 0) > CONFIG['session_max_age']
 
 def create_session(username):
     session_id = secrets.token_hex(32)
-    sessions[session_id] = {'username': username}
+    sessions.delete_where(session_expired)
+    sessions.put(session_key(session_id), {'username': username, 'created': time.time()})
     return session_id
 
 def verify_session(cookie_header, headers=None):
@@ -247,27 +2436,443 @@ def verify_session(cookie_header, headers=None):
     cookie = SimpleCookie()
     cookie.load(cookie_header)
     if 'session_id' in cookie:
-        return cookie['session_id'].value in sessions
+        key = session_key(cookie['session_id'].value)
+        with span('session lookup'):
+            session = sessions.get(key)
+        return session is not None and not session_expired(key, session)
     return False
 
+def session_username(cookie_header, headers=None):
+    """Username behind a request's SSO headers or session cookie, or None"""
+    if CONFIG['sso_enabled'] and headers:
+        authentik_user = headers.get('X-authentik-username') or headers.get('X-Authentik-Username')
+        if authentik_user:
+            return authentik_user
+    if not cookie_header:
+        return None
+    cookie = SimpleCookie()
+    cookie.load(cookie_header)
+    if 'session_id' not in cookie:
+        return None
+    key = session_key(cookie['session_id'].value)
+    session = sessions.get(key)
+    if session is None or session_expired(key, session):
+        return None
+    return session.get('username')
+
+def is_admin(cookie_header, headers=None):
+    user = users.get(session_username(cookie_header, headers) or '')
+    return user is not None and user.get('role') == 'admin'
+
 def destroy_session(cookie_header):
     if cookie_header:
         cookie = SimpleCookie()
         cookie.load(cookie_header)
         if 'session_id' in cookie:
-            sessions.pop(cookie['session_id'].value, None)
+            sessions.delete(session_key(cookie['session_id'].value))
 
 LOGIN_PAGE = '''<!DOCTYPE html><html><head><title>Peplink Manager - Login</title><meta charset="UTF-8"><meta name="viewport" content="width=device-width, initial-scale=1.0"><style>*{box-sizing:border-box;margin:0;padding:0}body{font-family:-apple-system,BlinkMacSystemFont,'Segoe UI',Roboto,sans-serif;background:#1a1a2e;color:#eee;min-height:100vh;display:flex;align-items:center;justify-content:center}.login-container{background:#16213e;padding:40px;border-radius:16px;box-shadow:0 20px 60px rgba(0,0,0,0.5);width:100%;max-width:400px;margin:20px}.login-header{text-align:center;margin-bottom:30px}.login-header h1{font-size:24px;margin-bottom:8px;color:#FF9800}.login-header p{color:#888;font-size:14px}.login-icon{font-size:48px;margin-bottom:15px}.form-group{margin-bottom:20px}.form-group label{display:block;margin-bottom:8px;font-size:12px;color:#888;text-transform:uppercase;letter-spacing:1px}.form-group input{width:100%;padding:14px 16px;border:1px solid #0f3460;border-radius:8px;background:#0f3460;color:#eee;font-size:16px;transition:border-color 0.2s}.form-group input:focus{outline:none;border-color:#FF9800}.login-btn{width:100%;padding:14px;background:linear-gradient(135deg,#FF9800,#F57C00);border:none;border-radius:8px;color:white;font-size:16px;font-weight:600;cursor:pointer;transition:transform 0.2s,box-shadow 0.2s}.login-btn:hover{transform:translateY(-2px);box-shadow:0 8px 25px rgba(255,152,0,0.3)}.error-msg{background:rgba(244,67,54,0.2);color:#f44336;padding:12px;border-radius:8px;margin-bottom:20px;font-size:14px;text-align:center;display:none}.error-msg.show{display:block}</style></head><body><div class="login-container"><div class="login-header"><div class="login-icon">📡</div><h1>Peplink Manager</h1><p>Sign in to access your devices</p></div><div class="error-msg" id="errorMsg">Invalid username or password</div><form method="POST" action="/login"><div class="form-group"><label>Username</label><input type="text" name="username" required autofocus></div><div class="form-group"><label>Password</label><input type="password" name="password" required></div><button type="submit" class="login-btn">Sign In</button></form></div><script>if(window.location.search.includes('error=1')){document.getElementById('errorMsg').classList.add('show');}</script></body></html>'''
 
-def get_main_page():
-    html_path = Path(__file__).parent / 'index.html'
-    return html_path.read_text()
+def accepted_encodings(header):
+    """Content codings the client accepts, from an Accept-Encoding header"""
+    accepted = set()
+    for part in (header or '').split(','):
+        coding, *params = part.split(';')
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if coding.strip() and quality > 0:
+            accepted.add(coding.strip().lower())
+    return accepted
+
+def choose_encoding(header):
+    accepted = accepted_encodings(header)
+    if brotli is not None and 'br' in accepted:
+        return 'br'
+    if 'gzip' in accepted:
+        return 'gzip'
+    return None
+
+def compress(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body, quality=5)
+    return zlib.compress(body, 6, wbits=31)
+
+class CompressionCache:
+    """Compressed bodies keyed by (etag, encoding), bounded by total size"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, etag, body, encoding):
+        compressed = self.lookup(etag, encoding)
+        if compressed is None:
+            compressed = compress(body, encoding)
+            self.store(etag, encoding, compressed)
+        return compressed
+
+    def lookup(self, etag, encoding):
+        key = (etag, encoding)
+        with self._lock:
+            compressed = self._entries.get(key)
+            if compressed is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return compressed
+
+    def store(self, etag, encoding, compressed):
+        key = (etag, encoding)
+        with self._lock:
+            if key not in self._entries and len(compressed) <= self.max_bytes:
+                self._entries[key] = compressed
+                self.size += len(compressed)
+                while self.size > self.max_bytes:
+                    _, evicted = self._entries.popitem(last=False)
+                    self.size -= len(evicted)
+
+compression_cache = CompressionCache(int(CONFIG['compress_cache_mb'] * 1024 * 1024))
+
+def make_etag(body):
+    return '"' + hashlib.sha1(body).hexdigest() + '"'
+
+# Inventory and cache versions restart with the process, so ETags built from them carry a per-process prefix
+VALIDATOR_PREFIX = secrets.token_hex(4)
+
+def validator_etag(*parts):
+    """ETag for a response identified by the versions of the data it is built from"""
+    return f'"{VALIDATOR_PREFIX}-' + hashlib.sha1(repr(parts).encode()).hexdigest() + '"'
+
+def etag_matches(header, etag):
+    if not header:
+        return False
+    candidates = [tag.strip() for tag in header.split(',')]
+    return '*' in candidates or etag in candidates or 'W/' + etag in candidates
+
+class StaticAsset:
+    """Response body held in memory with its ETag and precompressed variants"""
+
+    def __init__(self, body, content_type):
+        self.body = body
+        self.content_type = content_type
+        self.digest = hashlib.sha1(body).hexdigest()
+        self.etag = f'"{self.digest}"'
+        self.compressed = {'gzip': compress(body, 'gzip')}
+        if brotli is not None:
+            self.compressed['br'] = compress(body, 'br')
+
+STATIC_TYPES = {
+    '.css': 'text/css; charset=utf-8',
+    '.js': 'application/javascript; charset=utf-8',
+    '.html': 'text/html; charset=utf-8',
+}
+
+class StaticAssets:
+    """Dashboard page and its static files, loaded once and reloaded when a file's mtime changes.
+
+    index.html references assets as {{name}}; those placeholders are replaced
+    with content-hashed URLs that browsers may cache forever.
+    """
+
+    def __init__(self, page_path, static_dir, check_interval=5):
+        self.page_path = page_path
+        self.static_dir = static_dir
+        self.check_interval = check_interval
+        self.assets = {}
+        self.page = None
+        self._mtimes = {}
+        self._checked_at = 0
+        self._lock = threading.Lock()
+        self.reload()
+
+    def reload(self):
+        assets = {}
+        mtimes = {}
+        for path in sorted(self.static_dir.iterdir()):
+            if path.suffix in STATIC_TYPES:
+                assets[path.name] = StaticAsset(path.read_bytes(), STATIC_TYPES[path.suffix])
+                mtimes[path] = path.stat().st_mtime_ns
+        template = self.page_path.read_text()
+        mtimes[self.page_path] = self.page_path.stat().st_mtime_ns
+        for name in assets:
+            template = template.replace('{{' + name + '}}', self.url_for(name, assets))
+        self.assets = assets
+        self.page = StaticAsset(template.encode(), STATIC_TYPES['.html'])
+        self._mtimes = mtimes
+
+    def url_for(self, name, assets=None):
+        asset = (assets or self.assets)[name]
+        stem, dot, ext = name.rpartition('.')
+        return f'/static/{stem}.{asset.digest[:12]}.{ext}'
+
+    def refresh(self):
+        """Reload from disk if anything changed, checking at most once per interval"""
+        now = time.monotonic()
+        if now - self._checked_at < self.check_interval:
+            return
+        with self._lock:
+            if now - self._checked_at < self.check_interval:
+                return
+            self._checked_at = now
+            try:
+                current = {path: path.stat().st_mtime_ns for path in self._mtimes}
+                names = {path.name for path in self.static_dir.iterdir() if path.suffix in STATIC_TYPES}
+                if current != self._mtimes or names != set(self.assets):
+                    self.reload()
+                    print('[STATIC] Reloaded changed assets')
+            except OSError as e:
+                print(f'[STATIC] Reload failed: {e}')
+
+    def main_page(self):
+        self.refresh()
+        return self.page
+
+    def lookup(self, path):
+        """Return (asset, immutable) for /static/<stem>.<hash>.<ext>, or (None, False)"""
+        self.refresh()
+        stem, _, ext = path[len('/static/'):].rpartition('.')
+        stem, _, digest = stem.rpartition('.')
+        asset = self.assets.get(f'{stem}.{ext}')
+        if asset is None:
+            return None, False
+        # Old hashes still get the current file, just without the long-lived caching
+        return asset, asset.digest.startswith(digest) and len(digest) == 12
+
+static_assets = StaticAssets(Path(__file__).parent / 'index.html', Path(__file__).parent / 'static',
+                             check_interval=CONFIG['static_check_interval'])
+login_page = StaticAsset(LOGIN_PAGE.encode(), STATIC_TYPES['.html'])
+
+# Fixed routes are labelled as-is; anything carrying an id is mapped to a template
+FIXED_ROUTES = {'/', '/login', '/logout', '/health', '/metrics', '/api/orgs', '/api/tree', '/api/events', '/api/summary',
+                '/api/devices/search', '/api/inventory/changes', '/api/users', '/api/locked-groups',
+                '/api/group-lock', '/api/upstream', '/api/ic2/batch', '/api/debug/profile', '/api/debug/slow'}
+ROUTE_TEMPLATES = [
+    (re.compile(r'^/static/'), '/static/{asset}'),
+    (re.compile(r'^/api/groups/[^/]+$'), '/api/groups/{org}'),
+    (re.compile(r'^/api/devices/[^/]+$'), '/api/devices/{org}'),
+    (re.compile(r'^/api/groups/[^/]+/[^/]+/devices$'), '/api/groups/{org}/{group}/devices'),
+    (re.compile(r'^/api/history/[^/]+$'), '/api/history/{org}'),
+    (re.compile(r'^/api/history/[^/]+/[^/]+$'), '/api/history/{org}/{device}'),
+    (re.compile(r'^/api/users/[^/]+$'), '/api/users/{username}'),
+    (re.compile(r'^/api/ic2/'), '/api/ic2/{path}'),
+]
+
+def route_template(path):
+    if path in FIXED_ROUTES:
+        return path
+    for pattern, template in ROUTE_TEMPLATES:
+        if pattern.match(path):
+            return template
+    return 'other'
+
+def metric_lines(name, kind, help_text, samples):
+    """Exposition lines for a metric computed at scrape time from (labels, value) pairs"""
+    yield f'# HELP {name} {help_text}'
+    yield f'# TYPE {name} {kind}'
+    for labels, value in samples:
+        yield f'{name}{format_labels(tuple(labels), tuple(labels.values()))} {value}'
+
+def process_rss_bytes():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):
+        if resource is None:
+            return 0
+        # Peak rather than current RSS, but better than nothing off Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def render_metrics(server):
+    lines = []
+    for metric in METRICS:
+        lines.append(f'# HELP {metric.name} {metric.help_text}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        lines.extend(metric.render())
+
+    lines.extend(metric_lines('ic2_manager_http_queue_depth', 'gauge', 'Accepted connections waiting for a worker',
+                              [({}, server.pending.qsize())]))
+    lines.extend(metric_lines('ic2_manager_http_workers', 'gauge', 'Request worker threads', [({}, len(server.workers))]))
+
+    cache_results = [('hit', api_cache.hits), ('stale', api_cache.stale_hits), ('miss', api_cache.misses)]
+    compression_results = [('hit', compression_cache.hits), ('miss', compression_cache.misses)]
+    lines.extend(metric_lines('ic2_manager_cache_requests_total', 'counter', 'Cache lookups by result',
+                              [({'cache': 'ic2', 'result': result}, count) for result, count in cache_results] +
+                              [({'cache': 'compression', 'result': result}, count) for result, count in compression_results]))
+    ratios = []
+    for cache, results in (('ic2', cache_results), ('compression', compression_results)):
+        total = sum(count for _, count in results)
+        served = sum(count for result, count in results if result != 'miss')
+        ratios.append(({'cache': cache}, round(served / total, 4) if total else 0))
+    lines.extend(metric_lines('ic2_manager_cache_hit_ratio', 'gauge', 'Share of lookups served from cache (stale included)', ratios))
+    lines.extend(metric_lines('ic2_manager_compression_cache_bytes', 'gauge', 'Bytes held by the compression cache',
+                              [({}, compression_cache.size)]))
+
+    scheduler = upstream_scheduler.stats()
+    lanes = scheduler['lanes'].items()
+    lines.extend(metric_lines('ic2_manager_upstream_queue_depth', 'gauge', 'Upstream calls waiting for a rate limit token',
+                              [({'lane': lane}, stats['queued']) for lane, stats in lanes]))
+    lines.extend(metric_lines('ic2_manager_upstream_wait_seconds_total', 'counter', 'Time upstream calls spent waiting for a token',
+                              [({'lane': lane}, stats['wait_total_ms'] / 1000) for lane, stats in lanes]))
+    lines.extend(metric_lines('ic2_manager_upstream_throttled_total', 'counter', '429 responses that paused the scheduler',
+                              [({}, scheduler['throttled'])]))
+
+    device_count, inventory_version = inventory.size()
+    lines.extend(metric_lines('ic2_manager_inventory_devices', 'gauge', 'Devices in the polled inventory', [({}, device_count)]))
+    lines.extend(metric_lines('ic2_manager_inventory_version', 'counter', 'Inventory change log version', [({}, inventory_version)]))
+    lines.extend(metric_lines('ic2_manager_sse_clients', 'gauge', 'Connected /api/events streams', [({}, len(event_broker.clients))]))
+    if history is not None:
+        lines.extend(metric_lines('ic2_manager_history_queue_depth', 'gauge', 'History batches waiting to be written',
+                                  [({}, history.pending.qsize())]))
+    if snapshot_writer.last_write is not None:
+        lines.extend(metric_lines('ic2_manager_snapshot_written_seconds', 'gauge', 'When the inventory snapshot was last written',
+                                  [({}, snapshot_writer.last_write)]))
+
+    lines.extend(metric_lines('process_resident_memory_bytes', 'gauge', 'Resident memory size in bytes', [({}, process_rss_bytes())]))
+    lines.extend(metric_lines('process_start_time_seconds', 'gauge', 'Start time of the process since the epoch', [({}, PROCESS_STARTED)]))
+    lines.extend(metric_lines('ic2_manager_threads', 'gauge', 'Live Python threads', [({}, threading.active_count())]))
+    gc_stats = gc.get_stats()
+    lines.extend(metric_lines('python_gc_collections_total', 'counter', 'Garbage collections per generation',
+                              [({'generation': str(i)}, stats['collections']) for i, stats in enumerate(gc_stats)]))
+    lines.extend(metric_lines('python_gc_objects_collected_total', 'counter', 'Objects collected per generation',
+                              [({'generation': str(i)}, stats['collected']) for i, stats in enumerate(gc_stats)]))
+    lines.extend(metric_lines('python_gc_objects_pending', 'gauge', 'Allocations counted towards the next collection, per generation',
+                              [({'generation': str(i)}, count) for i, count in enumerate(gc.get_count())]))
+    return '\n'.join(lines) + '\n'
+
+PROCESS_STARTED = time.time()
+
+slow_requests = deque(maxlen=50)
+
+def record_slow_request(trace, method, path, status, elapsed):
+    """Log a request's span breakdown and keep it for /api/debug/slow"""
+    print(f'[SLOW] {method} {path} -> {status} in {elapsed * 1000:.0f}ms (request {trace.request_id})\n'
+          f'{trace.breakdown()}')
+    slow_requests.append({
+        'request_id': trace.request_id, 'method': method, 'path': path, 'status': status,
+        'at': time.time(), 'duration_ms': round(elapsed * 1000, 1),
+        'spans': [{'name': name, 'offset_ms': round(offset * 1000, 1), 'duration_ms': round(duration * 1000, 1),
+                   'thread': thread} for name, offset, duration, thread in trace.spans],
+    })
+
+# Leaf frames of threads that are parked rather than doing work
+IDLE_FUNCTIONS = {('threading.py', 'wait'), ('threading.py', '_wait_for_tstate_lock'), ('queue.py', 'get'),
+                  ('selectors.py', 'select'), ('socket.py', 'accept'), ('socket.py', 'readinto'),
+                  ('socketserver.py', 'serve_forever'), ('thread.py', '_worker')}
+
+class StackSampler:
+    """Statistical profiler: periodically snapshots every thread's stack via sys._current_frames.
+
+    Unlike cProfile it only sees the threads at sample time and adds no per-call
+    overhead, so it is safe to run against the live server.
+    """
+
+    def __init__(self, interval=0.005, include_idle=False):
+        self.interval = interval
+        self.include_idle = include_idle
+        self.samples = 0
+        self.stacks = {}
+
+    def run(self, duration):
+        me = threading.get_ident()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        deadline = time.monotonic() + duration
+        while time.monotonic() < deadline:
+            self.samples += 1
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                code = frame.f_code
+                if not self.include_idle and (os.path.basename(code.co_filename), code.co_name) in IDLE_FUNCTIONS:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                    frame = frame.f_back
+                # Thread pools share a name prefix; group their workers together
+                thread = re.sub(r'[-_]\d+$', '', names.get(ident, 'thread'))
+                key = (thread,) + tuple(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+            time.sleep(self.interval)
+
+    def collapsed(self):
+        """Brendan Gregg's folded format, one 'frame;frame;frame count' line per stack"""
+        lines = [f"{';'.join(stack)} {count}" for stack, count in
+                 sorted(self.stacks.items(), key=lambda item: -item[1])]
+        return '\n'.join(lines) + '\n'
+
+    def top(self, limit=40):
+        own = {}
+        total = {}
+        for stack, count in self.stacks.items():
+            own[stack[-1]] = own.get(stack[-1], 0) + count
+            for frame in set(stack[1:]):
+                total[frame] = total.get(frame, 0) + count
+        ranked = sorted(total, key=lambda frame: (-own.get(frame, 0), -total[frame]))[:limit]
+        return {'samples': self.samples, 'interval_ms': self.interval * 1000,
+                'functions': [{'function': frame, 'self': own.get(frame, 0), 'total': total[frame]}
+                              for frame in ranked]}
+
+profile_lock = threading.Lock()
+
+# JSON bodies that grow past this size are streamed with chunked encoding instead of buffered
+STREAM_MIN_BYTES = 1024 * 1024
+STREAM_CHUNK_SIZE = 64 * 1024
 
 class RequestHandler(http.server.BaseHTTPRequestHandler):
+    # HTTP/1.1 is needed for chunked responses
+    protocol_version = 'HTTP/1.1'
+    # Socket read/write deadline so a stalled client cannot pin a worker
+    timeout = CONFIG['request_timeout']
+
+    def handle_one_request(self):
+        self.status_code = None
+        self.trace = current_trace.trace = RequestTrace()
+        http_in_flight.inc(amount=1)
+        try:
+            super().handle_one_request()
+        finally:
+            current_trace.trace = None
+            http_in_flight.inc(amount=-1)
+            # Requests that failed to parse have no command or path
+            if self.status_code is not None and getattr(self, 'command', None):
+                elapsed = time.perf_counter() - self.trace.started
+                route = route_template(urlparse(self.path).path)
+                http_requests.inc(self.command, route, self.status_code)
+                http_latency.observe(elapsed, self.command, route)
+                if elapsed * 1000 >= CONFIG['slow_request_ms'] and route != '/api/debug/profile':
+                    record_slow_request(self.trace, self.command, self.path, self.status_code, elapsed)
+
+    def parse_request(self):
+        if not super().parse_request():
+            return False
+        # Keep the caller's request ID (e.g. from a reverse proxy) so logs on both sides line up
+        request_id = self.headers.get('X-Request-ID', '')
+        if REQUEST_ID_PATTERN.match(request_id):
+            self.trace.request_id = request_id
+        # The clock starts once the request line and headers are in, not while waiting for them
+        self.trace.started = time.perf_counter()
+        return True
+
+    def send_response(self, code, message=None):
+        self.status_code = code
+        super().send_response(code, message)
+
     def do_GET(self):
         path = urlparse(self.path).path
         if path == '/login':
-            self.send_html(LOGIN_PAGE)
+            self.send_asset(login_page)
             return
         if path == '/logout':
             destroy_session(self.headers.get('Cookie'))
@@ -276,34 +2881,125 @@ class RequestHandler(http.server.BaseHTTPRequestHandler):
         if path == '/health':
             self.send_json({'status': 'ok'})
             return
+        if path == '/metrics':
+            # Open to scrapers unless METRICS_TOKEN is set; a logged-in session also works
+            token = CONFIG['metrics_token']
+            if (token and not hmac.compare_digest(self.headers.get('Authorization', ''), f'Bearer {token}')
+                    and not verify_session(self.headers.get('Cookie'), self.headers)):
+                self.send_json({'error': 'Unauthorized'}, status=401)
+                return
+            self.send_body(render_metrics(self.server).encode(), 'text/plain; version=0.0.4; charset=utf-8')
+            return
         if not verify_session(self.headers.get('Cookie'), self.headers):
             self.redirect('/login')
             return
         if path == '/':
-            self.send_html(get_main_page())
+            self.send_asset(static_assets.main_page())
+        elif path.startswith('/static/'):
+            asset, immutable = static_assets.lookup(path)
+            if asset is None:
+                self.send_error(404)
+            elif immutable:
+                self.send_asset(asset, cache_control='private, max-age=31536000, immutable')
+            else:
+                self.send_asset(asset)
         elif path == '/api/orgs':
-            self.send_json(api.get('/rest/o') or [])
+            self.send_json(api_cache.get('/rest/o') or [])
+        elif path == '/api/tree':
+            query = parse_qs(urlparse(self.path).query)
+            # Read before the data so a change in between only costs the client a full response
+            etag = validator_etag(self.path, inventory.version, api_cache.version,
+                                  sorted(locked_groups.snapshot().items()))
+            tree = build_tree(include_devices=query.get('devices', [''])[0] != 'none')
+            if tree is None:
+                self.send_json({'error': 'IC2 API request failed'}, status=500)
+            else:
+                self.send_json_stream(tree_chunks(tree, parse_fields(query)), etag=etag)
+        elif re.match(r'^/api/groups/[^/]+/[^/]+/devices$', path):
+            org_id, group_id = path.split('/')[3:5]
+            etag = devices_etag(self.path, org_id, group_id)
+            devices = group_devices(org_id, group_id)
+            fields = parse_fields(parse_qs(urlparse(self.path).query))
+            if devices is None:
+                self.send_json({'error': 'IC2 API request failed'}, status=500)
+            else:
+                self.send_json_stream(json_array_chunks(project(devices, fields)), etag=etag)
         elif path.startswith('/api/groups/'):
             org_id = path.split('/')[-1]
-            groups = api.get(f'/rest/o/{org_id}/g') or []
-            # Add lock status to groups
-            for group in groups:
-                group_key = f"{org_id}-{group.get('id')}"
-                group['locked'] = locked_groups.get(group_key, False)
-            self.send_json(groups)
+            groups = api_cache.get(f'/rest/o/{org_id}/g') or []
+            fields = parse_fields(parse_qs(urlparse(self.path).query))
+            # Add lock status to copies so the cached groups stay untouched
+            self.send_json(list(project(with_lock_status(org_id, groups), fields)))
+        elif path == '/api/summary':
+            mark_inventory_stale()
+            body, etag = fleet_summary.encoded()
+            self.send_body(body, 'application/json', etag=etag)
+        elif path == '/api/devices/search':
+            try:
+                query = parse_qs(urlparse(self.path).query)
+                result = search_devices(query)
+                result['devices'] = list(project(result['devices'], parse_fields(query)))
+                self.send_json(result)
+            except (ValueError, TypeError) as e:
+                self.send_json({'error': f'Invalid search: {e}'}, status=400)
         elif path.startswith('/api/devices/'):
             org_id = path.split('/')[-1]
-            self.send_json(api.get(f'/rest/o/{org_id}/d') or [])
+            etag = devices_etag(self.path, org_id)
+            devices = org_devices(org_id) or []
+            fields = parse_fields(parse_qs(urlparse(self.path).query))
+            self.send_json_stream(json_array_chunks(project(devices, fields)), etag=etag)
+        elif path.startswith('/api/history/') and history is not None:
+            # /api/history/{org_id} for availability, /api/history/{org_id}/{device_id} for a series
+            parts = path.split('/')[3:]
+            query = parse_qs(urlparse(self.path).query)
+            try:
+                start, end = history_range(query)
+                if len(parts) == 1:
+                    with span('history availability'):
+                        availability = history.availability(parts[0], start, end)
+                    self.send_json({'from': start, 'to': end, 'availability': availability})
+                elif len(parts) == 2:
+                    resolution = query.get('resolution', ['auto'])[0]
+                    with span('history query'):
+                        series = history.query(parts[0], parts[1], start, end, resolution)
+                    self.send_json(series)
+                else:
+                    self.send_error(404)
+            except ValueError as e:
+                self.send_json({'error': str(e)}, status=400)
+        elif path == '/api/events':
+            self.start_event_stream()
+        elif path == '/api/inventory/changes':
+            # Device deltas since the version a client last saw
+            query = parse_qs(urlparse(self.path).query)
+            try:
+                since = int(query.get('since', ['-1'])[0])
+            except ValueError:
+                self.send_json({'error': 'since must be an integer'}, status=400)
+                return
+            version, changes = inventory.changes_since(since if since >= 0 else inventory.version)
+            if changes is None:
+                self.send_json({'version': version, 'resync': True})
+            else:
+                self.send_json({'version': version, 'changes': [change_to_json(c) for c in changes]})
+        elif path == '/api/upstream':
+            self.send_json(upstream_scheduler.stats())
+        elif path in ('/api/debug/profile', '/api/debug/slow'):
+            if not is_admin(self.headers.get('Cookie'), self.headers):
+                self.send_json({'error': 'Admin role required'}, status=403)
+            elif path == '/api/debug/slow':
+                self.send_json(list(slow_requests))
+            else:
+                self.send_profile(parse_qs(urlparse(self.path).query))
         elif path == '/api/users':
             # Get list of users (without passwords)
-            users_db = load_users_from_db()
             user_list = []
-            for username, info in users_db.items():
+            for username, info in users.snapshot().items():
                 user_list.append({'username': username, 'role': info.get('role', 'user')})
             self.send_json(user_list)
         elif path == '/api/locked-groups':
             # Get list of locked groups
-            self.send_json(locked_groups)
+            self.send_json(locked_groups.snapshot())
         else:
             self.send_error(404)
     
@@ -320,6 +3016,7 @@ class RequestHandler(http.server.BaseHTTPRequestHandler):
                 self.send_response(302)
                 self.send_header('Location', '/')
                 self.send_header('Set-Cookie', f'session_id={session_id}; Path=/; HttpOnly; SameSite=Strict')
+                self.send_header('Content-Length', '0')
                 self.end_headers()
                 print(f'[AUTH] User \'{username}\' logged in')
             else:
@@ -350,22 +3047,14 @@ class RequestHandler(http.server.BaseHTTPRequestHandler):
                 self.send_json({'error': 'Username and password required'}, status=400)
                 return
 
-            users_db = load_users_from_db()
-            if username in users_db:
+            if not users.add(username, {'password': encrypt_password(password), 'role': role}):
                 self.send_json({'error': 'User already exists'}, status=400)
                 return
-
-            users_db[username] = {
-                'password': encrypt_password(password),
-                'role': role
-            }
-            save_users_to_db(users_db)
             print(f'[USERS] Added new user: {username}')
             self.send_json({'success': True, 'username': username})
 
         elif path == '/api/group-lock':
             # Toggle group lock status
-            global locked_groups
             org_id = data.get('org_id')
             group_id = data.get('group_id')
             locked = data.get('locked', False)
@@ -376,19 +3065,26 @@ class RequestHandler(http.server.BaseHTTPRequestHandler):
 
             group_key = f"{org_id}-{group_id}"
             if locked:
-                locked_groups[group_key] = True
+                locked_groups.put(group_key, True)
                 print(f'[GROUPS] Locked group: {group_key}')
             else:
-                locked_groups.pop(group_key, None)
+                locked_groups.delete(group_key)
                 print(f'[GROUPS] Unlocked group: {group_key}')
-
-            save_locked_groups(locked_groups)
             self.send_json({'success': True, 'locked': locked})
 
+        elif path == '/api/ic2/batch':
+            try:
+                operations, parallelism = parse_batch(data)
+            except ValueError as e:
+                self.send_json({'error': str(e)}, status=400)
+                return
+            self.send_batch_results(operations, parallelism)
+
         elif path.startswith('/api/ic2/'):
             # Proxy POST requests to IC2 API
             ic2_path = path.replace('/api/ic2', '/rest')
             result = api.post(ic2_path, data)
+            api_cache.invalidate_path(ic2_path)
             if result:
                 self.send_json(result)
             else:
@@ -421,13 +3117,10 @@ class RequestHandler(http.server.BaseHTTPRequestHandler):
                 self.send_json({'error': 'Password required'}, status=400)
                 return
 
-            users_db = load_users_from_db()
-            if username not in users_db:
+            encrypted = encrypt_password(password)
+            if users.modify(username, lambda user: dict(user, password=encrypted)) is None:
                 self.send_json({'error': 'User not found'}, status=404)
                 return
-
-            users_db[username]['password'] = encrypt_password(password)
-            save_users_to_db(users_db)
             print(f'[USERS] Updated password for user: {username}')
             self.send_json({'success': True})
 
@@ -435,6 +3128,7 @@ class RequestHandler(http.server.BaseHTTPRequestHandler):
             # Proxy PUT requests to IC2 API
             ic2_path = path.replace('/api/ic2', '/rest')
             result = api.put(ic2_path, data)
+            api_cache.invalidate_path(ic2_path)
             if result:
                 self.send_json(result)
             else:
@@ -455,17 +3149,13 @@ class RequestHandler(http.server.BaseHTTPRequestHandler):
             # Delete user
             username = path.split('/')[-1]
 
-            users_db = load_users_from_db()
-            if username not in users_db:
-                self.send_json({'error': 'User not found'}, status=404)
-                return
-
             if username == 'alex':
                 self.send_json({'error': 'Cannot delete default admin user'}, status=403)
                 return
 
-            del users_db[username]
-            save_users_to_db(users_db)
+            if not users.delete(username):
+                self.send_json({'error': 'User not found'}, status=404)
+                return
             print(f'[USERS] Deleted user: {username}')
             self.send_json({'success': True})
 
@@ -473,6 +3163,7 @@ class RequestHandler(http.server.BaseHTTPRequestHandler):
             # Proxy DELETE requests to IC2 API
             ic2_path = path.replace('/api/ic2', '/rest')
             result = api.delete(ic2_path)
+            api_cache.invalidate_path(ic2_path)
             if result:
                 self.send_json(result)
             else:
@@ -481,25 +3172,208 @@ class RequestHandler(http.server.BaseHTTPRequestHandler):
         else:
             self.send_error(404)
 
-    def send_html(self, content):
-        self.send_response(200)
-        self.send_header('Content-Type', 'text/html; charset=utf-8')
-        self.send_header('Cache-Control', 'no-cache')
-        self.end_headers()
-        self.wfile.write(content.encode())
-    
+    def end_headers(self):
+        # One request per connection: idle keep-alive sockets would otherwise hold pool workers
+        if not self.close_connection:
+            self.send_header('Connection', 'close')
+        self.send_header('X-Request-ID', self.trace.request_id)
+        if self.trace.data_as_of is not None:
+            # Some of the response came from expired cache entries or the on-disk snapshot
+            self.send_header('X-Data-As-Of', formatdate(self.trace.data_as_of, usegmt=True))
+        super().end_headers()
+
     def send_json(self, data, status=200):
+        with span('encode json'):
+            body = json.dumps(data).encode()
+        self.send_body(body, 'application/json', status)
+
+    def send_asset(self, asset, cache_control='no-cache'):
+        self.send_body(asset.body, asset.content_type, etag=asset.etag,
+                       compressed=asset.compressed, cache_control=cache_control)
+
+    def send_body(self, body, content_type, status=200, etag=None, compressed=None, cache_control='no-cache'):
+        """Send body with an ETag, answering 304 on a match and compressing when worthwhile"""
+        if status == 200:
+            etag = etag or make_etag(body)
+            if etag_matches(self.headers.get('If-None-Match'), etag):
+                self.send_not_modified(etag, cache_control)
+                return
+        encoding = None
+        if len(body) >= CONFIG['compress_min_bytes']:
+            encoding = choose_encoding(self.headers.get('Accept-Encoding'))
+            with span('compress'):
+                if encoding and compressed and encoding in compressed:
+                    body = compressed[encoding]
+                elif encoding and etag:
+                    body = compression_cache.get(etag, body, encoding)
+                elif encoding:
+                    body = compress(body, encoding)
+        self.send_encoded(body, content_type, status, etag, encoding, cache_control)
+
+    def send_encoded(self, body, content_type, status=200, etag=None, encoding=None, cache_control='no-cache'):
+        """Send an already encoded body with Content-Length"""
         self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Cache-Control', cache_control)
+        self.send_header('Vary', 'Accept-Encoding')
+        if etag:
+            self.send_header('ETag', etag)
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        with span('socket write'):
+            self.wfile.write(body)
+
+    def send_not_modified(self, etag, cache_control='no-cache'):
+        self.send_response(304)
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', cache_control)
+        self.end_headers()
+
+    def send_json_stream(self, chunks, etag=None):
+        """Send JSON produced piecewise by chunks, using chunked transfer encoding
+        once it passes STREAM_MIN_BYTES and a single buffered body below that.
+
+        etag identifies the data the chunks are built from rather than the body,
+        so unchanged data is answered with a 304, or with the compressed body kept
+        from an earlier response, without encoding anything.
+        """
+        header = self.headers.get('Accept-Encoding')
+        if etag:
+            if etag_matches(self.headers.get('If-None-Match'), etag):
+                self.send_not_modified(etag)
+                return
+            # Large responses are only ever streamed gzipped, so that copy may be the one kept
+            for encoding in dict.fromkeys([choose_encoding(header), 'gzip']):
+                if encoding in accepted_encodings(header):
+                    cached = compression_cache.lookup(etag, encoding)
+                    if cached is not None:
+                        self.send_encoded(cached, 'application/json', etag=etag, encoding=encoding)
+                        return
+        chunks = iter(chunks)
+        buffer = []
+        size = 0
+        with span('encode json'):
+            for piece in chunks:
+                buffer.append(piece)
+                size += len(piece)
+                if size >= STREAM_MIN_BYTES:
+                    break
+            else:
+                body = ''.join(buffer).encode()
+        if size < STREAM_MIN_BYTES:
+            self.send_body(body, 'application/json', etag=etag)
+            return
+        gzip_stream = None
+        if 'gzip' in accepted_encodings(header):
+            gzip_stream = zlib.compressobj(6, zlib.DEFLATED, 31)
+        self.send_response(200)
         self.send_header('Content-Type', 'application/json')
         self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Vary', 'Accept-Encoding')
+        if etag:
+            self.send_header('ETag', etag)
+        if gzip_stream:
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        # Kept so the next request for unchanged data can skip encoding and compression
+        compressed = [] if etag and gzip_stream else None
+        # Encoding, compression and socket writes interleave here, so they share one span
+        with span('stream body'):
+            for piece in chunks:
+                buffer.append(piece)
+                size += len(piece)
+                if size >= STREAM_CHUNK_SIZE:
+                    data = ''.join(buffer).encode()
+                    if gzip_stream:
+                        data = gzip_stream.compress(data)
+                    if compressed is not None:
+                        compressed.append(data)
+                    self.write_chunk(data)
+                    buffer = []
+                    size = 0
+            data = ''.join(buffer).encode()
+            if gzip_stream:
+                data = gzip_stream.compress(data) + gzip_stream.flush()
+            if compressed is not None:
+                compressed.append(data)
+            self.write_chunk(data)
+            self.wfile.write(b'0\r\n\r\n')
+        if compressed is not None:
+            compression_cache.store(etag, 'gzip', b''.join(compressed))
+
+    def send_batch_results(self, operations, parallelism):
+        """Stream batch results as newline-delimited JSON, one line per finished operation"""
+        started = time.perf_counter()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('X-Accel-Buffering', 'no')
+        self.send_header('Transfer-Encoding', 'chunked')
         self.end_headers()
-        self.wfile.write(json.dumps(data).encode())
+        succeeded = failed = 0
+        for result in run_batch(operations, parallelism):
+            if result['ok']:
+                succeeded += 1
+            else:
+                failed += 1
+            self.write_chunk((json.dumps(result) + '\n').encode())
+        summary = {'done': True, 'succeeded': succeeded, 'failed': failed,
+                   'elapsed_ms': round((time.perf_counter() - started) * 1000)}
+        self.write_chunk((json.dumps(summary) + '\n').encode())
+        self.wfile.write(b'0\r\n\r\n')
+        print(f'[BATCH] {len(operations)} operations: {succeeded} ok, {failed} failed '
+              f'in {summary["elapsed_ms"]}ms')
+
+    def send_profile(self, query):
+        """Sample every thread's stack for a few seconds and return the aggregate"""
+        try:
+            seconds = min(float(query.get('seconds', ['10'])[0]), 60.0)
+            interval = max(float(query.get('interval_ms', ['5'])[0]), 1.0) / 1000
+        except ValueError:
+            self.send_json({'error': 'seconds and interval_ms must be numbers'}, status=400)
+            return
+        if not profile_lock.acquire(blocking=False):
+            self.send_json({'error': 'A profile is already running'}, status=409)
+            return
+        try:
+            print(f'[PROFILE] Sampling stacks for {seconds:.0f}s')
+            sampler = StackSampler(interval, include_idle=query.get('idle', ['0'])[0] == '1')
+            sampler.run(seconds)
+        finally:
+            profile_lock.release()
+        if query.get('format', ['json'])[0] == 'collapsed':
+            self.send_body(sampler.collapsed().encode(), 'text/plain; charset=utf-8')
+        else:
+            self.send_json(sampler.top())
+
+    def start_event_stream(self):
+        """Send event-stream headers, then hand the socket to the event broker"""
+        last_event_id = self.headers.get('Last-Event-ID') or parse_qs(urlparse(self.path).query).get('last_event_id', [None])[0]
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        # Stop reverse proxies from buffering the stream
+        self.send_header('X-Accel-Buffering', 'no')
+        self.end_headers()
+        self.wfile.flush()
+        self.server.detach(self.request)
+        event_broker.add_client(self.request, last_event_id)
+
+    def write_chunk(self, data):
+        # An empty chunk would terminate the response early
+        if not data:
+            return
+        self.wfile.write(f'{len(data):X}\r\n'.encode() + data + b'\r\n')
     
     def redirect(self, location, clear_session=False):
         self.send_response(302)
         self.send_header('Location', location)
         if clear_session:
             self.send_header('Set-Cookie', 'session_id=; Path=/; Max-Age=0')
+        self.send_header('Content-Length', '0')
         self.end_headers()
     
     def log_message(self, format, *args):
@@ -508,23 +3382,121 @@ class RequestHandler(http.server.BaseHTTPRequestHandler):
 class ReusableTCPServer(socketserver.TCPServer):
     allow_reuse_address = True
 
+BUSY_RESPONSE = (
+    b'HTTP/1.0 503 Service Unavailable\r\n'
+    b'Content-Type: application/json\r\n'
+    b'Retry-After: 1\r\n'
+    b'Content-Length: 24\r\n'
+    b'Connection: close\r\n\r\n'
+    b'{"error": "Server busy"}'
+)
+
+class PooledHTTPServer(ReusableTCPServer):
+    """TCP server that hands connections to a fixed pool of worker threads"""
+
+    def __init__(self, server_address, handler_class, workers=16, queue_size=128,
+                 request_timeout=30):
+        self.detached = set()
+        self.detached_lock = threading.Lock()
+        self.request_queue_size = queue_size
+        self.request_timeout = request_timeout
+        self.pending = queue.Queue(maxsize=queue_size)
+        super().__init__(server_address, handler_class)
+        self.workers = []
+        for i in range(workers):
+            worker = threading.Thread(target=self.process_queue, name=f'http-worker-{i}', daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def process_request(self, request, client_address):
+        """Queue the connection for a worker, or shed it when the queue is full"""
+        try:
+            self.pending.put_nowait((request, client_address, time.monotonic()))
+        except queue.Full:
+            print(f'[SERVER] Queue full, rejecting {client_address[0]}')
+            self.reject_request(request)
+
+    def process_queue(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return
+            request, client_address, queued_at = item
+            # The client has most likely given up on requests that waited past the deadline
+            if time.monotonic() - queued_at > self.request_timeout:
+                self.reject_request(request)
+                continue
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def detach(self, request):
+        """Leave a connection open after its handler returns; the caller now owns it"""
+        with self.detached_lock:
+            self.detached.add(request)
+
+    def shutdown_request(self, request):
+        with self.detached_lock:
+            if request in self.detached:
+                self.detached.discard(request)
+                return
+        super().shutdown_request(request)
+
+    def reject_request(self, request):
+        try:
+            request.sendall(BUSY_RESPONSE)
+        except OSError:
+            pass
+        self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        for _ in self.workers:
+            self.pending.put(None)
+
+def _raise_interrupt():
+    raise KeyboardInterrupt
+
 def run_server(port=8000):
     print('=' * 50)
     print('  Peplink InControl2 Manager')
     print('=' * 50)
     print(f'  Port: {port}')
     print(f'  API:  {CONFIG["api_url"]}')
+    print(f'  Workers: {CONFIG["workers"]} (queue {CONFIG["queue_size"]})')
     print('=' * 50)
+    if CONFIG['snapshot_enabled']:
+        # Without the poller, seeded orgs would never be refreshed but still be read from the inventory
+        snapshot_writer.restore(seed=CONFIG['poll_enabled'])
     api.authenticate()
-    with ReusableTCPServer(('0.0.0.0', port), RequestHandler) as httpd:
+    event_broker.start()
+    if history is not None:
+        history.start()
+    if CONFIG['poll_enabled']:
+        poller.start()
+    if CONFIG['snapshot_enabled']:
+        snapshot_writer.start()
+    with PooledHTTPServer(('0.0.0.0', port), RequestHandler,
+                          workers=CONFIG['workers'],
+                          queue_size=CONFIG['queue_size'],
+                          request_timeout=CONFIG['request_timeout']) as httpd:
         print(f'\n[SERVER] Running at http://localhost:{port}')
         print('[SERVER] Press Ctrl+C to stop\n')
+        # docker stop sends SIGTERM; turn it into the same clean shutdown as Ctrl+C
+        signal.signal(signal.SIGTERM, lambda signum, frame: _raise_interrupt())
         try:
             httpd.serve_forever()
         except KeyboardInterrupt:
             print('\n[SERVER] Shutting down...')
+        finally:
+            for store in (users, locked_groups, sessions):
+                store.flush()
+            if CONFIG['snapshot_enabled']:
+                snapshot_writer.write()
 
 if __name__ == '__main__':
-    import sys
     port = int(sys.argv[1]) if len(sys.argv) > 1 else CONFIG['port']
     run_server(port)
@@ -0,0 +1,767 @@
+var allDevices = {};
+// orgId-groupId -> devices, filled when a group is opened (or prefetched as a favorite)
+var groupDevices = {};
+var pendingLoads = {};
+var currentDevices = [];
+var selectedDevice = null;
+var currentView = 'expanded';
+var groupsData = {};
+var currentSelection = null;
+var refreshTimer = null;
+var favorites = JSON.parse(localStorage.getItem('peplinkFavorites') || '[]');
+
+function saveFavorites() {
+  localStorage.setItem('peplinkFavorites', JSON.stringify(favorites));
+  renderFavorites();
+}
+
+function toggleFavorite(orgId, groupId, groupName, e) {
+  if (e) e.stopPropagation();
+  var key = orgId + '-' + groupId;
+  var idx = favorites.findIndex(function(f) { return f.key === key; });
+  if (idx >= 0) {
+    favorites.splice(idx, 1);
+  } else {
+    favorites.push({ key: key, orgId: orgId, groupId: groupId, name: groupName });
+    loadGroupDevices(orgId, groupId).catch(function() {});
+  }
+  saveFavorites();
+  updateFavButtons();
+}
+
+function isFavorite(orgId, groupId) {
+  var key = orgId + '-' + groupId;
+  return favorites.some(function(f) { return f.key === key; });
+}
+
+function updateFavButtons() {
+  document.querySelectorAll('.fav-btn').forEach(function(btn) {
+    var orgId = btn.getAttribute('data-orgid');
+    var groupId = btn.getAttribute('data-groupid');
+    if (isFavorite(orgId, groupId)) {
+      btn.classList.add('favorited');
+      btn.innerHTML = '<span class="heart">❤️</span>';
+    } else {
+      btn.classList.remove('favorited');
+      btn.innerHTML = '<span class="heart">🤍</span>';
+    }
+  });
+}
+
+function renderFavorites() {
+  var container = document.getElementById('favoritesList');
+  if (favorites.length === 0) {
+    container.innerHTML = '<span class="favorites-empty">Click the heart next to a group to add favorites</span>';
+    return;
+  }
+  var html = '';
+  favorites.forEach(function(fav) {
+    html += '<div class="favorite-chip" onclick="goToGroup(\'' + fav.orgId + '\', ' + fav.groupId + ')">' +
+      '📁 ' + fav.name +
+      '<span class="remove-fav" onclick="removeFavorite(\'' + fav.key + '\', event)">×</span>' +
+    '</div>';
+  });
+  container.innerHTML = html;
+}
+
+function removeFavorite(key, e) {
+  e.stopPropagation();
+  favorites = favorites.filter(function(f) { return f.key !== key; });
+  saveFavorites();
+  updateFavButtons();
+}
+
+function goToGroup(orgId, groupId) {
+  document.querySelectorAll('.tree-item').forEach(function(e) { e.classList.remove('active'); });
+  var groupEl = document.querySelector('[data-orgid="' + orgId + '"][data-groupid="' + groupId + '"]');
+  if (groupEl) {
+    groupEl.classList.add('active');
+    groupEl.scrollIntoView({ behavior: 'smooth', block: 'center' });
+  }
+  closeDetail();
+  showGroup(orgId, parseInt(groupId));
+}
+
+function toggleGroupLock(orgId, groupId, currentLocked, e) {
+  if (e) e.stopPropagation();
+  var newLocked = !currentLocked;
+
+  fetch('/api/group-lock', {
+    method: 'POST',
+    headers: {'Content-Type': 'application/json'},
+    body: JSON.stringify({org_id: orgId, group_id: groupId, locked: newLocked})
+  })
+  .then(function(r) { return r.json(); })
+  .then(function(data) {
+    if (data.success) {
+      var btn = document.querySelector('.lock-btn[data-orgid="' + orgId + '"][data-groupid="' + groupId + '"]');
+      if (btn) {
+        if (newLocked) {
+          btn.classList.add('locked');
+          btn.innerHTML = '🔒';
+        } else {
+          btn.classList.remove('locked');
+          btn.innerHTML = '🔓';
+        }
+      }
+    }
+  })
+  .catch(function(e) { console.error('Lock toggle failed:', e); });
+}
+
+var staleTimer = null;
+
+// The server answers from its last snapshot when IC2 is slow or down and says so in X-Data-As-Of
+function showStaleness(asOf) {
+  var banner = document.getElementById('staleBanner');
+  clearTimeout(staleTimer);
+  if (!asOf) {
+    banner.style.display = 'none';
+    return;
+  }
+  var minutes = Math.max(0, Math.round((Date.now() - new Date(asOf).getTime()) / 60000));
+  banner.textContent = 'Showing saved data from ' + (minutes ? minutes + ' min ago' : 'moments ago') + ' while InControl2 is refreshed';
+  banner.style.display = 'block';
+  staleTimer = setTimeout(load, 15000);
+}
+
+function load() {
+  // Devices are fetched per group when one is opened
+  fetch('/api/tree?devices=none')
+    .then(function(r) {
+      showStaleness(r.headers.get('X-Data-As-Of'));
+      return r.json();
+    })
+    .then(function(tree) {
+      var orgs = tree.orgs || [];
+      if (orgs.length === 0) {
+        document.getElementById('tree').innerHTML = '<div class="empty-state">' + (tree.error || 'No organizations found') + '</div>';
+        return;
+      }
+      var html = '';
+      orgs.forEach(function(org) {
+        html += '<div class="tree-item org" data-orgid="' + org.id + '">🏢 ' + org.name + '</div>';
+        if (org.error) {
+          html += '<div class="org-error" title="' + org.error + '">⚠️ ' + org.error + '</div>';
+        }
+        (org.groups || []).forEach(function(g) {
+          groupsData[org.id + '-' + g.id] = { orgId: org.id, groupId: g.id, name: g.name };
+          var isFav = isFavorite(org.id, g.id);
+          var isLocked = g.locked || false;
+          html += '<div class="tree-item group" data-orgid="' + org.id + '" data-groupid="' + g.id + '">' +
+            '<button class="fav-btn ' + (isFav ? 'favorited' : '') + '" data-orgid="' + org.id + '" data-groupid="' + g.id + '" onclick="toggleFavorite(\'' + org.id + '\', ' + g.id + ', \'' + g.name.replace(/'/g, "\\'") + '\', event)">' +
+              '<span class="heart">' + (isFav ? '❤️' : '🤍') + '</span>' +
+            '</button>' +
+            '<button class="lock-btn ' + (isLocked ? 'locked' : '') + '" data-orgid="' + org.id + '" data-groupid="' + g.id + '" onclick="toggleGroupLock(\'' + org.id + '\', ' + g.id + ', ' + isLocked + ', event)">' +
+              (isLocked ? '🔒' : '🔓') +
+            '</button>' +
+            '<span class="group-name">📁 ' + g.name + '</span>' +
+            '<span class="group-stats"><span class="on">' + (g.online_device_count || 0) + '↑</span> <span class="off">' + (g.offline_device_count || 0) + '↓</span></span></div>';
+        });
+      });
+      allDevices = {};
+      groupDevices = {};
+      document.getElementById('tree').innerHTML = html;
+      renderFavorites();
+      prefetchFavorites();
+      if (currentSelection) refreshSelection();
+    })
+    .catch(function(e) {
+      document.getElementById('tree').innerHTML = '<div class="empty-state">Error loading: ' + e.message + '</div>';
+    });
+}
+
+// One delegated handler per container, so re-rendering the tree or the device list binds nothing
+function setupEvents() {
+  document.getElementById('tree').addEventListener('click', function(e) {
+    var item = e.target.closest('.tree-item');
+    if (!item || e.target.closest('.fav-btn, .lock-btn')) return;
+    var active = document.querySelector('.tree-item.active');
+    if (active) active.classList.remove('active');
+    item.classList.add('active');
+    var orgId = item.getAttribute('data-orgid');
+    var groupId = item.getAttribute('data-groupid');
+    closeDetail();
+    if (groupId) {
+      showGroup(orgId, parseInt(groupId));
+    } else {
+      showOrg(orgId);
+    }
+  });
+
+  document.querySelector('.detail-tabs').addEventListener('click', function(e) {
+    var tab = e.target.closest('.detail-tab');
+    if (!tab) return;
+    document.querySelectorAll('.detail-tab').forEach(function(t) { t.classList.remove('active'); });
+    tab.classList.add('active');
+    if (selectedDevice) renderDetailTab(tab.getAttribute('data-tab'));
+  });
+
+  var devices = document.getElementById('devices');
+  devices.addEventListener('click', function(e) {
+    var cardEl = e.target.closest('.device-card');
+    if (!cardEl) return;
+    var selected = devices.querySelector('.device-card.selected');
+    if (selected) selected.classList.remove('selected');
+    cardEl.classList.add('selected');
+    showDetail(parseInt(cardEl.getAttribute('data-idx')));
+  });
+  devices.addEventListener('scroll', function() {
+    if (windowFrame) return;
+    windowFrame = requestAnimationFrame(function() {
+      windowFrame = null;
+      renderWindow(false);
+    });
+  });
+  window.addEventListener('resize', function() { renderWindow(false); });
+  ['deviceFilter', 'statusFilter', 'deviceSort'].forEach(function(id) {
+    document.getElementById(id).addEventListener('input', function() { requestView(null); });
+  });
+}
+
+function setView(view) {
+  currentView = view;
+  document.getElementById('compactBtn').classList.toggle('active', view === 'compact');
+  document.getElementById('expandedBtn').classList.toggle('active', view === 'expanded');
+  document.getElementById('devices').className = 'devices-grid ' + view;
+  renderWindow(true);
+}
+
+// Fetch a device list once, sharing the request between callers that ask while it's in flight
+function fetchDevices(key, url, store) {
+  if (store[key]) return Promise.resolve(store[key]);
+  if (!pendingLoads[url]) {
+    pendingLoads[url] = fetch(url)
+      .then(function(r) {
+        if (!r.ok) throw new Error('HTTP ' + r.status);
+        return r.json();
+      })
+      .then(function(devices) {
+        store[key] = devices;
+        return devices;
+      })
+      .finally(function() { delete pendingLoads[url]; });
+  }
+  return pendingLoads[url];
+}
+
+function loadGroupDevices(orgId, groupId) {
+  var key = orgId + '-' + groupId;
+  // A whole-org list already loaded covers the group without another request
+  if (!groupDevices[key] && allDevices[orgId]) {
+    groupDevices[key] = allDevices[orgId].filter(function(d) { return d.group_id === groupId; });
+  }
+  return fetchDevices(key, '/api/groups/' + orgId + '/' + groupId + '/devices', groupDevices);
+}
+
+function loadOrgDevices(orgId) {
+  return fetchDevices(orgId, '/api/devices/' + orgId, allDevices);
+}
+
+function prefetchFavorites() {
+  favorites.forEach(function(fav) {
+    loadGroupDevices(fav.orgId, parseInt(fav.groupId)).catch(function() {});
+  });
+}
+
+function showLoading(title) {
+  document.getElementById('devicesTitle').innerText = title;
+  document.getElementById('devicesCount').innerText = '';
+  document.getElementById('devices').innerHTML = '<div class="empty-state"><div class="empty-state-icon">⏳</div><div>Loading devices...</div></div>';
+}
+
+// quiet re-renders in place (live updates, reloads) instead of flashing the loading state
+function showDevices(selection, promise, title, quiet) {
+  if (!quiet) showLoading(title);
+  promise
+    .then(function(devices) {
+      if (currentSelection !== selection) return;
+      document.getElementById('devicesTitle').innerText = title;
+      renderDevices(devices);
+    })
+    .catch(function(e) {
+      if (currentSelection !== selection) return;
+      document.getElementById('devices').innerHTML = '<div class="empty-state">Error loading devices: ' + e.message + '</div>';
+    });
+}
+
+function showOrg(orgId, quiet) {
+  currentSelection = { orgId: orgId, groupId: null };
+  var orgName = document.querySelector('[data-orgid="' + orgId + '"].org');
+  showDevices(currentSelection, loadOrgDevices(orgId), orgName ? orgName.innerText.replace('🏢 ', '') : 'All Devices', quiet);
+}
+
+function showGroup(orgId, groupId, quiet) {
+  currentSelection = { orgId: orgId, groupId: groupId };
+  var group = groupsData[orgId + '-' + groupId];
+  showDevices(currentSelection, loadGroupDevices(orgId, groupId), group ? group.name : 'Group', quiet);
+}
+
+function refreshSelection() {
+  if (currentSelection.groupId !== null) {
+    showGroup(currentSelection.orgId, currentSelection.groupId, true);
+  } else {
+    showOrg(currentSelection.orgId, true);
+  }
+}
+
+// Sorting, filtering and card formatting run in devices-worker.js; results come back as
+// pre-formatted rows, of which only the ones scrolled into view are turned into DOM nodes
+var deviceWorker = null;
+var viewSeq = 0;
+var viewDevices = [];
+var viewRows = [];
+var windowFrame = null;
+var renderedWindow = null;
+// Minimum card widths (as in the old auto-fill grid) and the fixed card heights from app.css
+var CARD_SIZES = { expanded: { width: 300, height: 330 }, compact: { width: 180, height: 160 } };
+var GRID_GAP = 15;
+var GRID_PADDING = 20;
+// Rows rendered above and below the visible ones, so fast scrolling doesn't show gaps
+var OVERSCAN_ROWS = 2;
+
+function startDeviceWorker() {
+  var url = document.body.getAttribute('data-worker') + '?format=' + encodeURIComponent(document.body.getAttribute('data-format'));
+  deviceWorker = new Worker(url);
+  deviceWorker.onmessage = function(e) {
+    if (e.data.seq !== viewSeq) return;
+    currentDevices = viewDevices;
+    viewRows = e.data.rows;
+    var count = e.data.total + ' devices';
+    if (viewRows.length !== e.data.total) count = viewRows.length + ' of ' + count;
+    document.getElementById('devicesCount').innerText = count;
+    renderedWindow = null;
+    renderWindow(true);
+  };
+}
+
+// Send the worker a new device list (or null to re-filter the current one)
+function requestView(devices) {
+  if (!devices && viewSeq === 0) return;
+  if (devices) viewDevices = devices;
+  viewSeq++;
+  deviceWorker.postMessage({
+    seq: viewSeq,
+    devices: devices,
+    filter: document.getElementById('deviceFilter').value,
+    status: document.getElementById('statusFilter').value,
+    sort: document.getElementById('deviceSort').value
+  });
+}
+
+function renderDevices(devices) {
+  requestView(devices);
+}
+
+function renderWindow(force) {
+  // Nothing selected yet: leave the welcome message alone
+  if (viewSeq === 0) return;
+  var container = document.getElementById('devices');
+  if (viewRows.length === 0) {
+    if (renderedWindow === 'empty') return;
+    renderedWindow = 'empty';
+    var message = viewDevices.length ? 'No devices match the filter' : 'No devices in this group';
+    container.innerHTML = '<div class="empty-state"><div class="empty-state-icon">📭</div><div>' + message + '</div></div>';
+    return;
+  }
+  var size = CARD_SIZES[currentView];
+  var columns = Math.max(1, Math.floor((container.clientWidth - 2 * GRID_PADDING + GRID_GAP) / (size.width + GRID_GAP)));
+  var pitch = size.height + GRID_GAP;
+  var rowCount = Math.ceil(viewRows.length / columns);
+  var top = container.scrollTop - GRID_PADDING;
+  var first = Math.max(0, Math.floor(top / pitch) - OVERSCAN_ROWS);
+  var last = Math.min(rowCount, Math.ceil((top + container.clientHeight) / pitch) + OVERSCAN_ROWS);
+  var key = [currentView, columns, first, last].join(':');
+  if (!force && renderedWindow === key) return;
+
+  var spacer = container.querySelector('.devices-spacer');
+  if (!spacer) {
+    container.innerHTML = '<div class="devices-spacer"><div class="devices-window"></div></div>';
+    spacer = container.firstChild;
+  }
+  // The spacer keeps the full scroll height; only the window's cards exist in the DOM
+  spacer.style.height = (rowCount * pitch - GRID_GAP) + 'px';
+  var win = spacer.firstChild;
+  win.style.transform = 'translateY(' + first * pitch + 'px)';
+  win.style.gridTemplateColumns = 'repeat(' + columns + ', 1fr)';
+  var html = '';
+  for (var i = first * columns; i < Math.min(viewRows.length, last * columns); i++) {
+    html += deviceCard(viewRows[i]);
+  }
+  win.innerHTML = html;
+  renderedWindow = key;
+}
+
+function deviceCard(r) {
+  var statusClass = r.online ? 'online' : 'offline';
+  var statusText = r.online ? 'Online' : 'Offline';
+  var selected = selectedDevice && currentDevices[r.idx] === selectedDevice ? ' selected' : '';
+  var icon = getDeviceIcon(r.type);
+  if (currentView === 'expanded') {
+    return '<div class="device-card' + selected + '" data-idx="' + r.idx + '">' +
+      '<div class="device-status-bar ' + statusClass + '"></div>' +
+      '<div class="card-header">' +
+        '<div class="card-icon">' + icon + '</div>' +
+        '<div class="card-title">' +
+          '<div class="card-name">' + r.name + '</div>' +
+          '<div class="card-model">' + (r.model || 'Unknown Model') + '</div>' +
+        '</div>' +
+        '<div class="card-status-badge ' + statusClass + '">' + statusText + '</div>' +
+      '</div>' +
+      '<div class="card-body">' +
+        '<div class="card-stat"><div class="card-stat-label">Clients</div><div class="card-stat-value">' + r.clients + '</div></div>' +
+        '<div class="card-stat"><div class="card-stat-label">PepVPN Peers</div><div class="card-stat-value">' + r.peers + '</div></div>' +
+        '<div class="card-stat"><div class="card-stat-label">Uptime</div><div class="card-stat-value">' + r.uptime + '</div></div>' +
+        '<div class="card-stat"><div class="card-stat-label">Firmware</div><div class="card-stat-value">' + r.firmware + '</div></div>' +
+        '<div class="card-stat"><div class="card-stat-label">Serial</div><div class="card-stat-value">' + r.sn + '</div></div>' +
+        '<div class="card-stat"><div class="card-stat-label">IP Address</div><div class="card-stat-value">' + r.ip + '</div></div>' +
+      '</div>' +
+      (r.tags.length > 0 ? '<div class="card-footer">' + r.tags.map(function(t) { return '<span class="card-tag">' + t + '</span>'; }).join('') + (r.moreTags ? '<span class="card-tag">+' + r.moreTags + '</span>' : '') + '</div>' : '') +
+      '</div>';
+  }
+  return '<div class="device-card' + selected + '" data-idx="' + r.idx + '">' +
+    '<div class="device-status-bar ' + statusClass + '"></div>' +
+    '<div class="device-content">' +
+      '<div class="device-icon">' + icon + '</div>' +
+      '<div class="device-name">' + r.name + '</div>' +
+      '<div class="device-model">' + r.model + '</div>' +
+      '<div class="device-status ' + statusClass + '">' + statusText + '</div>' +
+      '<div class="device-meta"><span>👥 ' + r.clients + '</span><span>🔗 ' + r.peers + '</span></div>' +
+    '</div></div>';
+}
+
+function getDeviceIcon(type) {
+  var icons = { 'balancemax': '📡', 'peplink': '📡', 'balance': '🖧', 'ap2g': '📶', 'ap': '📶', 'switch': '🔌', 'fusionhub': '☁️' };
+  return icons[type] || '📡';
+}
+
+function showDetail(idx) {
+  selectedDevice = currentDevices[idx];
+  var d = selectedDevice;
+  
+  document.getElementById('detailName').innerText = d.name || 'Unknown';
+  document.getElementById('detailModel').innerText = d.product_name || d.model || '';
+  renderDetailStatus(d);
+  
+  document.getElementById('detailPanel').classList.add('open');
+  renderDetailTab('overview');
+  document.querySelectorAll('.detail-tab').forEach(function(t) { t.classList.remove('active'); });
+  document.querySelector('.detail-tab[data-tab="overview"]').classList.add('active');
+}
+
+function renderDetailStatus(d) {
+  var isOnline = d.status === 'online' || d.onlineStatus === 'ONLINE';
+  document.getElementById('detailStatusDot').className = 'status-dot ' + (isOnline ? 'online' : 'offline');
+  document.getElementById('detailStatusText').innerText = isOnline ? 'Online' : 'Offline';
+  document.getElementById('detailStatusText').style.color = isOnline ? '#4CAF50' : '#f44336';
+}
+
+function closeDetail() {
+  document.getElementById('detailPanel').classList.remove('open');
+  selectedDevice = null;
+}
+
+function renderDetailTab(tab) {
+  var d = selectedDevice;
+  var html = '';
+  var isOnline = d.status === 'online' || d.onlineStatus === 'ONLINE';
+  
+  if (tab === 'overview') {
+    html += '<div class="detail-section"><h4>Device Information</h4>';
+    html += row('Serial Number', d.sn);
+    html += row('Model', d.product_name || d.model);
+    html += row('Product Code', d.product_code);
+    html += row('Hardware Ver', d.hardware_version);
+    html += row('Firmware', d.fw_ver);
+    html += row('Group', d.group_name);
+    html += row('Timezone', d.group_timezone_label);
+    html += '</div>';
+    
+    html += '<div class="detail-section"><h4>Status</h4>';
+    html += row('Status', isOnline ? '🟢 Online' : '🔴 Offline');
+    html += row('Uptime', formatUptime(d.uptime));
+    html += row('Last Online', formatDate(d.last_online));
+    html += row('Last Offline', formatDate(d.offline_at));
+    html += row('First Seen', formatDate(d.first_appear));
+    html += '</div>';
+    
+    html += '<div class="detail-section"><h4>Location</h4>';
+    html += row('Address', d.address || 'N/A');
+    html += row('GPS', d.gps_exist ? '✅ Available' : '❌ N/A');
+    html += '</div>';
+    
+    if (d.tags && d.tags.length > 0) {
+      html += '<div class="detail-section"><h4>Tags</h4><div style="margin-top:5px;">';
+      d.tags.forEach(function(t) { html += '<span class="tag">' + t + '</span>'; });
+      html += '</div></div>';
+    }
+  } else if (tab === 'network') {
+    html += '<div class="detail-section"><h4>Network</h4>';
+    html += row('IP Address', d.wtp_ip || 'N/A');
+    html += row('LAN MAC', d.lan_mac || 'N/A');
+    html += row('Site ID', d.site_id || 'N/A');
+    html += row('Clients', d.client_count || 0);
+    html += '</div>';
+    
+    html += '<div class="detail-section"><h4>SpeedFusion / PepVPN</h4>';
+    html += row('PepVPN Peers', d.pepvpn_peers || 0);
+    html += row('SF Cloud', d.sf_cloud_supported ? '✅ Supported' : '❌ No');
+    html += row('SF Cloud Limit', d.sf_cloud_peer_limit || 'N/A');
+    html += row('Hub Support', d.hub_support ? '✅' : '❌');
+    html += row('DR Support', d.dr_support ? '✅' : '❌');
+    html += '</div>';
+    
+    html += '<div class="detail-section"><h4>Wireless</h4>';
+    html += row('SSID Count', d.support_ssid_count || 'N/A');
+    html += row('WiFi Config', d.wifi_cfg || 'N/A');
+    html += row('Mesh Support', d.max_wifi_mesh_support || 0);
+    html += '</div>';
+  } else if (tab === 'features') {
+    html += '<div class="feature-grid">';
+    html += feat('👥', 'Clients', d.client_count || 0);
+    html += feat('🔗', 'VPN Peers', d.pepvpn_peers || 0);
+    html += feat('📶', 'SSIDs', d.support_ssid_count || 0);
+    html += feat('⏱️', 'Uptime', formatUptimeShort(d.uptime));
+    html += '</div>';
+    
+    html += '<div class="detail-section" style="margin-top:15px;"><h4>Features</h4>';
+    html += row('DPI', d.dpi_enabled ? '✅ Enabled' : '❌ Disabled');
+    html += row('Remote Assist', d.ra_supported ? '✅ Supported' : '❌ No');
+    html += row('Watchdog', d.watchdog_enabled ? '✅ Enabled' : '❌ Disabled');
+    html += row('eSIM', d.is_esim_supported ? '✅ (' + (d.max_esim_support || 0) + ')' : '❌ No');
+    html += row('Cellular', d.is_cellular_module_supported ? '✅' : '❌');
+    html += row('Starlink WAN', d.is_starlink_wan_supported ? '✅' : '❌');
+    html += row('DDNS', d.ddns_enabled ? '✅' : '❌');
+    html += '</div>';
+    
+    html += '<div class="detail-section"><h4>IC Management</h4>';
+    html += row('VLAN', d.vlan_managed ? '✅' : '❌');
+    html += row('Outbound', d.outbound_policy_managed ? '✅' : '❌');
+    html += row('Firewall', d.firewall_rules_managed ? '✅' : '❌');
+    html += row('WLAN', d.icmg_wlan ? '✅' : '❌');
+    html += row('LAN', d.icmg_lan ? '✅' : '❌');
+    html += '</div>';
+  } else if (tab === 'license') {
+    html += '<div class="detail-section"><h4>Warranty</h4>';
+    html += row('Expiry', formatDate(d.expiry_date));
+    html += row('Status', d.expired ? '❌ Expired' : '✅ Active');
+    html += row('HW Expired', d.hw_expired ? '❌ Yes' : '✅ No');
+    html += '</div>';
+    
+    html += '<div class="detail-section"><h4>PrimeCare</h4>';
+    html += row('Expiry', formatDate(d.prime_expiry_date));
+    html += row('Status', d.prime_expired ? '❌ Expired' : '✅ Active');
+    html += row('Type', d.prime_type || 'N/A');
+    html += '</div>';
+    
+    html += '<div class="detail-section"><h4>Licensing</h4>';
+    html += row('MVPN License', d.mvpn_license || 'N/A');
+    html += row('MVPN Version', d.mvpn_version || 'N/A');
+    html += '</div>';
+  } else if (tab === 'history') {
+    html += '<div class="history-ranges">' + ['24h', '7d', '30d'].map(function(r) {
+      return '<button class="view-btn" data-range="' + r + '" onclick="loadHistory(\'' + r + '\')">' + r + '</button>';
+    }).join('') + '</div><div id="historyChart" class="history-chart">Loading...</div>';
+    document.getElementById('detailContent').innerHTML = html;
+    loadHistory('24h');
+    return;
+  }
+  
+  document.getElementById('detailContent').innerHTML = html;
+}
+
+function loadHistory(range) {
+  var d = selectedDevice;
+  if (!d || !currentSelection) return;
+  document.querySelectorAll('.history-ranges .view-btn').forEach(function(b) {
+    b.classList.toggle('active', b.getAttribute('data-range') === range);
+  });
+  fetch('/api/history/' + currentSelection.orgId + '/' + d.id + '?range=' + range)
+    .then(function(r) { return r.json(); })
+    .then(function(h) {
+      var el = document.getElementById('historyChart');
+      if (!el || selectedDevice !== d) return;
+      if (h.error || !h.points || h.points.length === 0) {
+        el.innerHTML = '<div class="empty-state">' + (h.error || 'No history recorded yet') + '</div>';
+        return;
+      }
+      var html = '<div class="detail-section"><h4>Availability</h4>';
+      html += row('Online', h.availability !== null ? (h.availability * 100).toFixed(2) + '%' : null);
+      if (h.availability !== null) html += row('Offline', formatUptime(Math.round((1 - h.availability) * (h.to - h.from))));
+      html += row('Resolution', h.resolution);
+      html += '</div>';
+      html += '<div class="detail-section"><h4>Online</h4>' + historyChart(h, 1, '#4CAF50') + '</div>';
+      html += '<div class="detail-section"><h4>Clients (avg)</h4>' + historyChart(h, 2, '#FF9800') + '</div>';
+      el.innerHTML = html;
+    })
+    .catch(function(e) {
+      var el = document.getElementById('historyChart');
+      if (el) el.innerHTML = '<div class="empty-state">Error loading history: ' + e.message + '</div>';
+    });
+}
+
+function historyChart(h, column, color) {
+  var w = 380, ht = 80;
+  var max = Math.max.apply(null, h.points.map(function(p) { return p[column]; }).concat([1]));
+  var span = Math.max(h.to - h.from, 1);
+  var pts = h.points.map(function(p) {
+    return ((p[0] - h.from) / span * w).toFixed(1) + ',' + (ht - p[column] / max * ht).toFixed(1);
+  });
+  return '<svg class="history-svg" viewBox="0 0 ' + w + ' ' + ht + '" preserveAspectRatio="none">' +
+    '<polyline fill="none" stroke="' + color + '" stroke-width="1.5" points="' + pts.join(' ') + '"/></svg>' +
+    '<div class="history-axis"><span>' + formatDate(new Date(h.from * 1000).toISOString()) + '</span><span>max ' + max + '</span></div>';
+}
+
+function row(l, v) { return '<div class="detail-row"><span class="detail-label">' + l + '</span><span class="detail-value">' + (v !== undefined && v !== null ? v : 'N/A') + '</span></div>'; }
+function feat(i, l, v) { return '<div class="feature-item"><div class="feature-icon">' + i + '</div><div class="feature-label">' + l + '</div><div class="feature-value">' + v + '</div></div>'; }
+
+// User Management Functions
+function showUserManagement() {
+  document.getElementById('userModal').classList.add('open');
+  loadUsers();
+}
+
+function closeUserManagement() {
+  document.getElementById('userModal').classList.remove('open');
+}
+
+function loadUsers() {
+  fetch('/api/users')
+    .then(function(r) { return r.json(); })
+    .then(function(users) {
+      var html = '';
+      users.forEach(function(user) {
+        var isDefault = user.username === 'alex';
+        html += '<div class="user-item">' +
+          '<div>' +
+            '<span class="user-name">' + user.username + '</span>' +
+            '<span class="user-role">' + user.role + '</span>' +
+          '</div>' +
+          '<div class="user-actions">' +
+            '<button class="btn btn-small btn-primary" onclick="changeUserPassword(\'' + user.username + '\')">Change Password</button>' +
+            (!isDefault ? '<button class="btn btn-small btn-danger" onclick="deleteUser(\'' + user.username + '\')">Delete</button>' : '') +
+          '</div>' +
+        '</div>';
+      });
+      document.getElementById('userList').innerHTML = html || '<div style="text-align:center;padding:20px;color:#888;">No users found</div>';
+    })
+    .catch(function(e) {
+      document.getElementById('userList').innerHTML = '<div style="text-align:center;padding:20px;color:#f44336;">Error loading users</div>';
+    });
+}
+
+function addUser() {
+  var username = document.getElementById('newUsername').value.trim();
+  var password = document.getElementById('newPassword').value.trim();
+  var role = document.getElementById('newRole').value;
+
+  if (!username || !password) {
+    alert('Please enter username and password');
+    return;
+  }
+
+  fetch('/api/users', {
+    method: 'POST',
+    headers: {'Content-Type': 'application/json'},
+    body: JSON.stringify({username: username, password: password, role: role})
+  })
+  .then(function(r) { return r.json(); })
+  .then(function(data) {
+    if (data.success) {
+      document.getElementById('newUsername').value = '';
+      document.getElementById('newPassword').value = '';
+      document.getElementById('newRole').value = 'user';
+      loadUsers();
+    } else {
+      alert(data.error || 'Failed to add user');
+    }
+  })
+  .catch(function(e) { alert('Error adding user'); });
+}
+
+function changeUserPassword(username) {
+  var newPassword = prompt('Enter new password for ' + username + ':');
+  if (!newPassword) return;
+
+  fetch('/api/users/' + username, {
+    method: 'PUT',
+    headers: {'Content-Type': 'application/json'},
+    body: JSON.stringify({password: newPassword})
+  })
+  .then(function(r) { return r.json(); })
+  .then(function(data) {
+    if (data.success) {
+      alert('Password updated successfully');
+    } else {
+      alert(data.error || 'Failed to update password');
+    }
+  })
+  .catch(function(e) { alert('Error updating password'); });
+}
+
+function deleteUser(username) {
+  if (!confirm('Are you sure you want to delete user "' + username + '"?')) return;
+
+  fetch('/api/users/' + username, {method: 'DELETE'})
+  .then(function(r) { return r.json(); })
+  .then(function(data) {
+    if (data.success) {
+      loadUsers();
+    } else {
+      alert(data.error || 'Failed to delete user');
+    }
+  })
+  .catch(function(e) { alert('Error deleting user'); });
+}
+
+// Live updates pushed by the server; EventSource reconnects and resumes via Last-Event-ID
+function listenForEvents() {
+  if (!window.EventSource) return;
+  var source = new EventSource('/api/events');
+  source.addEventListener('group', function(e) {
+    var g = JSON.parse(e.data);
+    var stats = document.querySelector('.tree-item.group[data-orgid="' + g.org_id + '"][data-groupid="' + g.group_id + '"] .group-stats');
+    if (stats) {
+      stats.innerHTML = '<span class="on">' + g.online_device_count + '↑</span> <span class="off">' + g.offline_device_count + '↓</span>';
+    }
+  });
+  source.addEventListener('device', function(e) {
+    var ev = JSON.parse(e.data);
+    // Only the lists this page has loaded are kept up to date; others are fetched fresh when opened
+    [[allDevices, ev.org_id], [groupDevices, ev.org_id + '-' + ev.group_id]].forEach(function(target) {
+      var store = target[0], key = target[1];
+      var devices = store[key];
+      if (!devices) return;
+      if (ev.op === 'add') {
+        // The list may already hold the device if it was fetched from IC2 before the poller loaded the org
+        var index = devices.findIndex(function(d) { return d.id === ev.device_id; });
+        if (index === -1) devices.push(ev.device);
+        else devices[index] = ev.device;
+      } else if (ev.op === 'remove') {
+        store[key] = devices.filter(function(d) { return d.id !== ev.device_id; });
+      } else {
+        var device = devices.find(function(d) { return d.id === ev.device_id; });
+        if (device) {
+          Object.assign(device, ev.changes);
+          if (device === selectedDevice) renderDetailStatus(device);
+        }
+      }
+    });
+    scheduleRefresh(ev.org_id);
+  });
+  source.addEventListener('resync', function() { load(); });
+}
+
+function scheduleRefresh(orgId) {
+  if (!currentSelection || currentSelection.orgId !== orgId || refreshTimer) return;
+  // Coalesce bursts of device events into one re-render
+  refreshTimer = setTimeout(function() {
+    refreshTimer = null;
+    refreshSelection();
+  }, 500);
+}
+
+startDeviceWorker();
+setupEvents();
+load();
+listenForEvents();
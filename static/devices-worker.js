@@ -0,0 +1,78 @@
+// Filters, sorts and formats the device list for the dashboard off the main thread.
+// Started as devices-worker.js?format=<url of format.js> so both share the helpers.
+importScripts(new URL(self.location.href).searchParams.get('format'));
+
+var entries = [];
+
+function isOnline(d) {
+  return d.status === 'online' || d.onlineStatus === 'ONLINE';
+}
+
+function lower(value) {
+  return String(value || '').toLowerCase();
+}
+
+// Everything a device card shows, formatted once per list
+function card(d, idx) {
+  var tags = d.tags || [];
+  return {
+    idx: idx,
+    name: d.name || 'Unknown',
+    model: d.product_name || d.model || '',
+    type: d.product_type || d.device_type,
+    online: isOnline(d),
+    clients: d.client_count || 0,
+    peers: d.pepvpn_peers || 0,
+    uptime: formatUptimeShort(d.uptime),
+    firmware: d.fw_ver ? d.fw_ver.split(' ')[0] : 'N/A',
+    sn: d.sn || 'N/A',
+    ip: d.wtp_ip || 'N/A',
+    tags: tags.slice(0, 3),
+    moreTags: Math.max(0, tags.length - 3)
+  };
+}
+
+// Sort name -> key function; ties fall back to the device name
+var SORTS = {
+  name: function() { return 0; },
+  status: function(e) { return e.card.online ? 1 : 0; },
+  clients: function(e) { return -e.card.clients; },
+  uptime: function(e) { return -(e.device.uptime || 0); },
+  model: function(e) { return lower(e.card.model); },
+  firmware: function(e) { return e.card.firmware; }
+};
+
+function load(devices) {
+  entries = devices.map(function(d, idx) {
+    var c = card(d, idx);
+    return {
+      device: d,
+      card: c,
+      name: lower(c.name),
+      text: [c.name, c.model, d.sn, d.wtp_ip, d.lan_mac, d.group_name].concat(d.tags || []).map(lower).join('\n')
+    };
+  });
+}
+
+function view(filter, status, sort) {
+  var needle = lower(filter).trim();
+  var matched = entries.filter(function(e) {
+    if (status === 'online' && !e.card.online) return false;
+    if (status === 'offline' && e.card.online) return false;
+    return !needle || e.text.indexOf(needle) !== -1;
+  });
+  var key = SORTS[sort] || SORTS.name;
+  matched.forEach(function(e) { e.key = key(e); });
+  matched.sort(function(a, b) {
+    if (a.key < b.key) return -1;
+    if (a.key > b.key) return 1;
+    return a.name < b.name ? -1 : a.name > b.name ? 1 : 0;
+  });
+  return matched.map(function(e) { return e.card; });
+}
+
+self.onmessage = function(e) {
+  var msg = e.data;
+  if (msg.devices) load(msg.devices);
+  self.postMessage({ seq: msg.seq, total: entries.length, rows: view(msg.filter, msg.status, msg.sort) });
+};
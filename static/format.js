@@ -0,0 +1,23 @@
+// Formatting helpers shared by app.js and devices-worker.js
+
+function formatUptime(s) {
+  if (!s) return 'N/A';
+  var d = Math.floor(s / 86400), h = Math.floor((s % 86400) / 3600), m = Math.floor((s % 3600) / 60);
+  if (d > 0) return d + 'd ' + h + 'h ' + m + 'm';
+  if (h > 0) return h + 'h ' + m + 'm';
+  return m + 'm';
+}
+
+function formatUptimeShort(s) {
+  if (!s) return 'N/A';
+  var d = Math.floor(s / 86400), h = Math.floor((s % 86400) / 3600);
+  return d > 0 ? d + 'd ' + h + 'h' : h + 'h';
+}
+
+function formatDate(str) {
+  if (!str) return 'N/A';
+  try {
+    var dt = new Date(str);
+    return dt.toLocaleDateString() + ' ' + dt.toLocaleTimeString([], {hour: '2-digit', minute:'2-digit'});
+  } catch(e) { return str; }
+}
@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+"""
+Load-test the dashboard endpoints and report latency, throughput and memory as JSON.
+
+Against a running app:
+
+    python tools/bench.py --url http://127.0.0.1:8000 --concurrency 32 --duration 30
+
+Or let it start tools/mock_ic2.py and app.py itself, in a scratch data directory:
+
+    python tools/bench.py --spawn --orgs 50 --devices 10000 --output bench.json
+
+With --baseline, the run is compared to an earlier output file and the exit
+status is 1 if any endpoint's p99, throughput or successful request count
+regressed by more than --max-regression, or its error rate rose, so it can
+gate a deploy.
+"""
+
+import argparse
+import gzip
+import http.client
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+from urllib.parse import urlparse, urlencode
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# name -> path; {org} is replaced with a real org id fetched at startup
+DEFAULT_ENDPOINTS = {
+    'orgs': '/api/orgs',
+    'tree': '/api/tree',
+    'groups': '/api/groups/{org}',
+    'devices': '/api/devices/{org}',
+    'devices_fields': '/api/devices/{org}?fields=id,name,status',
+    'search': '/api/devices/search?status=offline&limit=100',
+    'health': '/health',
+}
+
+class Client:
+    """One HTTP request per connection, matching the server's Connection: close"""
+
+    def __init__(self, url, cookie=None, gzip=True):
+        parsed = urlparse(url)
+        self.host = parsed.hostname
+        self.port = parsed.port or 80
+        self.headers = {'Accept-Encoding': 'gzip' if gzip else 'identity'}
+        if cookie:
+            self.headers['Cookie'] = cookie
+
+    def request(self, method, path, body=None, headers=None, timeout=60, decode=False):
+        conn = http.client.HTTPConnection(self.host, self.port, timeout=timeout)
+        try:
+            conn.request(method, path, body=body, headers=dict(self.headers, **(headers or {})))
+            response = conn.getresponse()
+            data = response.read()
+            if decode and response.getheader('Content-Encoding') == 'gzip':
+                data = gzip.decompress(data)
+            return response.status, response.getheaders(), data
+        finally:
+            conn.close()
+
+def login(url, username, password):
+    client = Client(url)
+    status, headers, _ = client.request('POST', '/login', urlencode({'username': username, 'password': password}),
+                                        {'Content-Type': 'application/x-www-form-urlencoded'})
+    for name, value in headers:
+        if name.lower() == 'set-cookie' and value.startswith('session_id=') and 'Max-Age=0' not in value:
+            return value.split(';')[0]
+    raise SystemExit(f'Login failed ({status}); check --user/--password')
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return round(sorted_values[index] * 1000, 2)
+
+def summarize(latencies, errors, elapsed):
+    latencies.sort()
+    return {
+        'requests': len(latencies), 'errors': errors,
+        'rps': round(len(latencies) / elapsed, 1) if elapsed else 0,
+        'p50_ms': percentile(latencies, 0.50), 'p90_ms': percentile(latencies, 0.90),
+        'p99_ms': percentile(latencies, 0.99), 'max_ms': percentile(latencies, 1.0),
+    }
+
+class MemoryWatcher(threading.Thread):
+    """Peak RSS of the server, from /proc when it's local, otherwise from its /metrics"""
+
+    def __init__(self, client, pid=None, interval=0.5):
+        super().__init__(daemon=True)
+        self.client = client
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0
+        self.stopped = threading.Event()
+
+    def sample(self):
+        if self.pid:
+            try:
+                status = Path(f'/proc/{self.pid}/status').read_text()
+                return int(re.search(r'VmHWM:\s+(\d+) kB', status).group(1)) * 1024
+            except (OSError, AttributeError):
+                pass
+        try:
+            _, _, body = self.client.request('GET', '/metrics', headers={'Accept-Encoding': 'identity'}, timeout=5)
+            match = re.search(rb'^process_resident_memory_bytes (\S+)$', body, re.M)
+            return int(float(match.group(1))) if match else 0
+        except OSError:
+            return 0
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.peak = max(self.peak, self.sample())
+        self.peak = max(self.peak, self.sample())
+
+def run_endpoint(client, path, concurrency, duration, max_requests):
+    latencies = []
+    errors = [0]
+    deadline = time.monotonic() + duration
+    remaining = [max_requests]
+    lock = threading.Lock()
+
+    def worker():
+        own = []
+        while time.monotonic() < deadline:
+            if max_requests:
+                with lock:
+                    if remaining[0] <= 0:
+                        break
+                    remaining[0] -= 1
+            started = time.perf_counter()
+            try:
+                status, _, _ = client.request('GET', path)
+                ok = status < 400
+            except OSError:
+                ok = False
+            if ok:
+                own.append(time.perf_counter() - started)
+            else:
+                with lock:
+                    errors[0] += 1
+        with lock:
+            latencies.extend(own)
+
+    started = time.monotonic()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return summarize(latencies, errors[0], time.monotonic() - started)
+
+def wait_for(url, health_path='/health', timeout=300):
+    client = Client(url)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if client.request('GET', health_path, timeout=2)[0] == 200:
+                return
+        except OSError:
+            pass
+        time.sleep(0.2)
+    raise SystemExit(f'{url} did not become healthy within {timeout}s')
+
+def spawn(args, workdir):
+    """Start the mock and the app; returns (processes, app pid)"""
+    mock_cmd = [sys.executable, str(ROOT / 'tools' / 'mock_ic2.py'), '--port', str(args.mock_port),
+                '--orgs', str(args.orgs), '--devices', str(args.devices), '--latency-ms', str(args.latency_ms)]
+    mock = subprocess.Popen(mock_cmd, stdout=subprocess.DEVNULL)
+    # The app authenticates on startup, so the mock has to be serving first
+    wait_for(f'http://127.0.0.1:{args.mock_port}', '/mock/stats')
+    env = dict(os.environ, PEPLINK_API_URL=f'http://127.0.0.1:{args.mock_port}', DATA_DIR=str(workdir),
+               PORT=str(args.app_port), PYTHONUNBUFFERED='1')
+    log = open(Path(workdir) / 'app.log', 'w')
+    app = subprocess.Popen([sys.executable, str(ROOT / 'app.py')], env=env, stdout=log, stderr=subprocess.STDOUT)
+    return [app, mock], app.pid
+
+def error_rate(stats):
+    attempts = stats['requests'] + stats.get('errors', 0)
+    return stats.get('errors', 0) / attempts if attempts else 0
+
+def compare(results, baseline, max_regression):
+    """Endpoints whose p99, throughput or successful requests regressed past the allowed fraction,
+    or whose error rate went up"""
+    regressions = []
+    # Request counts only line up when both runs lasted equally long
+    same_duration = baseline.get('duration') == results['duration']
+    for name, current in results['endpoints'].items():
+        previous = baseline.get('endpoints', {}).get(name)
+        if not previous:
+            continue
+        if ((same_duration or not current['requests']) and previous['requests']
+                and current['requests'] < previous['requests'] * (1 - max_regression)):
+            regressions.append(f"{name}: {previous['requests']} -> {current['requests']} successful requests")
+        if current['errors'] > previous.get('errors', 0) and error_rate(current) > error_rate(previous):
+            regressions.append(f"{name}: errors {previous.get('errors', 0)} ({error_rate(previous):.1%}) -> "
+                               f"{current['errors']} ({error_rate(current):.1%})")
+        if not current['requests']:
+            # Nothing succeeded, so there are no latencies to compare
+            continue
+        if previous.get('p99_ms') and current['p99_ms'] > previous['p99_ms'] * (1 + max_regression):
+            regressions.append(f"{name}: p99 {previous['p99_ms']}ms -> {current['p99_ms']}ms")
+        if previous.get('rps') and current['rps'] < previous['rps'] * (1 - max_regression):
+            regressions.append(f"{name}: {previous['rps']} -> {current['rps']} req/s")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://127.0.0.1:8000')
+    parser.add_argument('--user', default='alex')
+    parser.add_argument('--password', default='hyrox')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=10, help='seconds per endpoint')
+    parser.add_argument('--requests', type=int, default=0, help='stop each endpoint after this many requests')
+    parser.add_argument('--warmup', type=float, default=2, help='seconds of traffic per endpoint before measuring')
+    parser.add_argument('--endpoints', default=','.join(DEFAULT_ENDPOINTS),
+                        help='comma-separated names from the default set, or name=/path entries')
+    parser.add_argument('--no-gzip', action='store_true', help='do not send Accept-Encoding: gzip')
+    parser.add_argument('--output', help='write the JSON report here as well as to stdout')
+    parser.add_argument('--baseline', help='earlier JSON report to compare against')
+    parser.add_argument('--max-regression', type=float, default=0.2)
+    parser.add_argument('--pid', type=int, help='server pid, for peak RSS from /proc')
+    spawn_group = parser.add_argument_group('spawned mock and app (--spawn)')
+    spawn_group.add_argument('--spawn', action='store_true')
+    spawn_group.add_argument('--orgs', type=int, default=5)
+    spawn_group.add_argument('--devices', type=int, default=1000)
+    spawn_group.add_argument('--latency-ms', type=float, default=50)
+    spawn_group.add_argument('--mock-port', type=int, default=9100)
+    spawn_group.add_argument('--app-port', type=int, default=8800)
+    args = parser.parse_args()
+
+    processes = []
+    workdir = tempfile.TemporaryDirectory(prefix='ic2-bench-') if args.spawn else None
+    try:
+        if args.spawn:
+            processes, args.pid = spawn(args, workdir.name)
+            args.url = f'http://127.0.0.1:{args.app_port}'
+        wait_for(args.url)
+        client = Client(args.url, login(args.url, args.user, args.password), gzip=not args.no_gzip)
+        status, _, body = client.request('GET', '/api/orgs', decode=True)
+        if status != 200:
+            raise SystemExit(f'GET /api/orgs failed ({status}); is the IC2 API reachable?')
+        org_id = str(json.loads(body)[0]['id'])
+
+        endpoints = {}
+        for entry in args.endpoints.split(','):
+            name, _, path = entry.partition('=')
+            endpoints[name] = (path or DEFAULT_ENDPOINTS[name]).replace('{org}', org_id)
+
+        watcher = MemoryWatcher(client, args.pid)
+        watcher.start()
+        results = {'url': args.url, 'concurrency': args.concurrency, 'duration': args.duration,
+                   'gzip': not args.no_gzip, 'endpoints': {}}
+        if args.spawn:
+            results['fleet'] = {'orgs': args.orgs, 'devices_per_org': args.devices, 'latency_ms': args.latency_ms}
+        for name, path in endpoints.items():
+            if args.warmup:
+                run_endpoint(client, path, args.concurrency, args.warmup, 0)
+            results['endpoints'][name] = dict(run_endpoint(client, path, args.concurrency, args.duration, args.requests),
+                                              path=path)
+            print(f"[BENCH] {name}: {results['endpoints'][name]}", file=sys.stderr)
+        watcher.stopped.set()
+        watcher.join()
+        results['peak_rss_bytes'] = watcher.peak
+
+        if args.baseline:
+            results['regressions'] = compare(results, json.loads(Path(args.baseline).read_text()), args.max_regression)
+        report = json.dumps(results, indent=2)
+        print(report)
+        if args.output:
+            Path(args.output).write_text(report + '\n')
+        return 1 if results.get('regressions') else 0
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait(timeout=10)
+        if workdir:
+            workdir.cleanup()
+
+if __name__ == '__main__':
+    sys.exit(main())
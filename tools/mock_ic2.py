@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+"""
+Stand-in for the InControl2 API endpoints used by app.py, for local load testing.
+
+Serves a synthetic fleet and can inject latency, 5xx errors, 401s (expired or
+revoked tokens) and 429s (rate limiting). Point the app at it with
+PEPLINK_API_URL=http://127.0.0.1:9100.
+
+    python tools/mock_ic2.py --orgs 50 --devices 10000 --latency-ms 80
+"""
+
+import argparse
+import http.server
+import json
+import random
+import re
+import secrets
+import threading
+import time
+from urllib.parse import urlparse, parse_qs
+
+MODELS = [('BR1 Mini', 'MAX-BR1-MINI'), ('BR1 Pro 5G', 'MAX-BR1-PRO-5GH'), ('Balance 20X', 'BPL-021X'),
+          ('MAX Transit', 'MAX-TST-DUO'), ('Balance 310X', 'BPL-310X'), ('AP One AX', 'APO-AX')]
+FIRMWARE = ['8.3.0 build 5231', '8.4.1 build 5340', '8.5.0 build 5396', '8.5.1 build 5412']
+TAGS = ['vehicle', 'branch', 'kiosk', 'backup', 'pilot', 'depot']
+WRITE_RESPONSE = json.dumps({'resp_code': 'SUCCESS', 'caller_ref': None}).encode()
+
+def build_fleet(orgs, groups, devices, seed):
+    """{org_id: (org, [groups], [devices])} with stable pseudo-random content"""
+    rng = random.Random(seed)
+    fleet = {}
+    device_id = 0
+    for o in range(orgs):
+        org_id = f'org{o:03d}'
+        org = {'id': org_id, 'name': f'Org {o:03d}', 'primary': o == 0, 'status': 'active'}
+        group_list = [{'id': g + 1, 'name': f'Group {g + 1}', 'type': 'normal', 'online_device_count': 0,
+                       'offline_device_count': 0, 'timezone': 'UTC'} for g in range(groups)]
+        device_list = []
+        for d in range(devices):
+            device_id += 1
+            group = group_list[rng.randrange(groups)]
+            product_name, product_code = rng.choice(MODELS)
+            online = rng.random() < 0.9
+            device_list.append({
+                'id': device_id, 'name': f'{org_id}-dev{d:05d}', 'sn': f'{rng.randrange(16**12):012X}',
+                'status': 'online' if online else 'offline', 'online': online,
+                'group_id': group['id'], 'group_name': group['name'], 'group_timezone_label': 'UTC',
+                'product_name': product_name, 'product_code': product_code, 'model': product_code,
+                'hardware_version': str(rng.randint(1, 3)), 'fw_ver': rng.choice(FIRMWARE),
+                'client_count': rng.randint(0, 40) if online else 0,
+                'uptime': rng.randint(60, 90 * 86400) if online else 0,
+                'tags': rng.sample(TAGS, rng.randint(0, 2)), 'lan_mac': f'10:56:CA:{rng.randrange(16**6):06X}',
+                'wtp_ip': f'10.{rng.randrange(256)}.{rng.randrange(256)}.{rng.randrange(1, 255)}',
+                'last_online': '2024-05-01T10:00:00', 'offline_at': None if online else '2024-05-02T08:30:00',
+                'first_appear': '2022-01-15T09:00:00', 'expiry_date': '2027-01-01', 'expired': False,
+                'pepvpn_peers': rng.randint(0, 4), 'support_ssid_count': 4, 'watchdog_enabled': True,
+                'address': f'{rng.randint(1, 999)} Example Street',
+            })
+            group['online_device_count' if online else 'offline_device_count'] += 1
+        fleet[org_id] = (org, group_list, device_list)
+    return fleet
+
+class Faults:
+    """Injected behaviour shared by all handler threads"""
+
+    def __init__(self, args):
+        self.latency = args.latency_ms / 1000
+        self.jitter = args.jitter_ms / 1000
+        self.error_rate = args.error_rate
+        self.unauthorized_rate = args.unauthorized_rate
+        self.throttle_rate = args.throttle_rate
+        self.rate_limit = args.rate_limit
+        self.token_ttl = args.token_ttl
+        self.flap_rate = args.flap_rate
+        self.tokens = {}
+        self.window = (0, 0)
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def count(self, key):
+        with self.lock:
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def over_rate_limit(self):
+        """Fixed one-second window, like IC2's per-client quota"""
+        if not self.rate_limit:
+            return False
+        now = int(time.time())
+        with self.lock:
+            second, used = self.window
+            if second != now:
+                second, used = now, 0
+            self.window = (second, used + 1)
+            return used >= self.rate_limit
+
+    def issue_token(self):
+        token = secrets.token_hex(16)
+        with self.lock:
+            self.tokens[token] = time.time() + self.token_ttl
+        return token
+
+    def token_valid(self, token):
+        with self.lock:
+            expires = self.tokens.get(token)
+        return expires is not None and time.time() < expires
+
+class MockHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    fleet = {}
+    faults = None
+    bodies = {}
+
+    def send_json(self, body, status=200, headers=()):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return self.rfile.read(length) if length else b''
+
+    def inject(self):
+        """Apply latency and faults; returns True when a fault response was sent"""
+        faults = self.faults
+        delay = faults.latency + random.uniform(-faults.jitter, faults.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        token = parse_qs(urlparse(self.path).query).get('access_token', [''])[0]
+        if not faults.token_valid(token) or random.random() < faults.unauthorized_rate:
+            faults.count('401')
+            self.send_json({'resp_code': 'UNAUTHORIZED', 'message': 'Invalid access token'}, 401)
+            return True
+        if faults.over_rate_limit() or random.random() < faults.throttle_rate:
+            faults.count('429')
+            self.send_json({'resp_code': 'TOO_MANY_REQUESTS'}, 429, [('Retry-After', '1')])
+            return True
+        if random.random() < faults.error_rate:
+            faults.count('5xx')
+            self.send_json({'resp_code': 'INTERNAL_ERROR'}, random.choice([500, 502, 503]))
+            return True
+        return False
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        body = self.read_body()
+        if path == '/api/oauth2/token':
+            self.faults.count('token')
+            params = parse_qs(body.decode())
+            if params.get('grant_type', [''])[0] != 'client_credentials':
+                self.send_json({'error': 'unsupported_grant_type'}, 400)
+                return
+            self.send_json({'access_token': self.faults.issue_token(), 'token_type': 'bearer',
+                            'expires_in': self.faults.token_ttl})
+            return
+        self.write()
+
+    def do_PUT(self):
+        self.read_body()
+        self.write()
+
+    def do_DELETE(self):
+        self.write()
+
+    def write(self):
+        self.faults.count('write')
+        if self.inject():
+            return
+        if not urlparse(self.path).path.startswith('/rest/'):
+            self.send_json({'resp_code': 'NOT_FOUND'}, 404)
+            return
+        self.send_json(WRITE_RESPONSE)
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == '/mock/stats':
+            with self.faults.lock:
+                self.send_json(dict(self.faults.counts))
+            return
+        self.faults.count('read')
+        if self.inject():
+            return
+        if path == '/rest/o':
+            self.send_json({'resp_code': 'SUCCESS', 'data': [org for org, _, _ in self.fleet.values()]})
+            return
+        match = re.match(r'^/rest/o/([^/]+)/(g|d)$', path) or re.match(r'^/rest/o/([^/]+)/g/(\d+)/d$', path)
+        if not match or match.group(1) not in self.fleet:
+            self.send_json({'resp_code': 'NOT_FOUND'}, 404)
+            return
+        org, groups, devices = self.fleet[match.group(1)]
+        if match.group(2) == 'g':
+            self.send_json({'resp_code': 'SUCCESS', 'data': groups})
+        elif match.group(2) == 'd':
+            self.send_json(self.device_body(org['id'], devices))
+        else:
+            group_id = int(match.group(2))
+            self.send_json({'resp_code': 'SUCCESS', 'data': [d for d in devices if d['group_id'] == group_id]})
+
+    def device_body(self, org_id, devices):
+        if self.faults.flap_rate:
+            # Flip a few devices per fetch so pollers see a changing fleet
+            for device in random.sample(devices, int(len(devices) * self.faults.flap_rate)):
+                device['online'] = not device['online']
+                device['status'] = 'online' if device['online'] else 'offline'
+            return {'resp_code': 'SUCCESS', 'data': devices}
+        body = self.bodies.get(org_id)
+        if body is None:
+            body = self.bodies[org_id] = json.dumps({'resp_code': 'SUCCESS', 'data': devices}).encode()
+        return body
+
+    def log_message(self, format, *args):
+        pass
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9100)
+    parser.add_argument('--orgs', type=int, default=5)
+    parser.add_argument('--groups', type=int, default=10, help='groups per org')
+    parser.add_argument('--devices', type=int, default=1000, help='devices per org')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--latency-ms', type=float, default=50, help='added to every API call')
+    parser.add_argument('--jitter-ms', type=float, default=20)
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of calls answered 500/502/503')
+    parser.add_argument('--unauthorized-rate', type=float, default=0.0, help='fraction of calls answered 401')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='fraction of calls answered 429')
+    parser.add_argument('--rate-limit', type=int, default=0, help='calls per second before answering 429 (0 = off)')
+    parser.add_argument('--token-ttl', type=int, default=3600, help='seconds an access token stays valid')
+    parser.add_argument('--flap-rate', type=float, default=0.0, help='fraction of devices changing status per fetch')
+    args = parser.parse_args()
+
+    started = time.monotonic()
+    MockHandler.fleet = build_fleet(args.orgs, args.groups, args.devices, args.seed)
+    MockHandler.faults = Faults(args)
+    print(f'[MOCK] {args.orgs} orgs x {args.devices} devices built in {time.monotonic() - started:.1f}s')
+    server = http.server.ThreadingHTTPServer((args.host, args.port), MockHandler)
+    server.daemon_threads = True
+    print(f'[MOCK] IC2 mock listening on http://{args.host}:{args.port}', flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()